@@ -2,8 +2,26 @@ import libtcodpy as libtcod
 import math
 import textwrap
 import shelve
+import heapq
+import itertools
+import sys
+import time
+import zlib
+import multiprocessing
+import json
+import tracemalloc
+import os
+import struct
+import shutil
+import threading
 from ctypes import *
 
+try:  #import NumPy if available, the batch AI needs it
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
 SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
 
@@ -22,6 +40,15 @@ MAX_ROOMS = 30
 FOV_ALGO = 0  #default FOV algorithm
 FOV_LIGHT_WALLS = True
 TORCH_RANGE = 10
+PATH_CACHE_SIZE = 256 #paths kept per level before the oldest are dropped
+PATH_REPAIR_LOOKAHEAD = 4 #how far along a blocked path a detour tries to rejoin it
+BATCH_AI = False #step basic monsters in one vectorized pass (needs NumPy), which plays out differently
+ACTIVATION_RADIUS = 15 #monsters further than this from the player may fall asleep
+SECTOR_SIZE = 8 #sleeping monsters are bucketed in square sectors of this size
+COMBAT_NOISE = 8 #how far the sound of a fight carries
+FLEE_FACTOR = -1.2 #how much flee maps favour escape routes over plain distance
+PRECOMPUTE_VISIBILITY = False #build a visible set for every floor tile after make_map
+VISIBILITY_CHUNK = 64 #floor tiles handed to a worker process at a time
 
 INVENTORY_WIDTH = 50
 CANCEL_USE = 'cancelled'
@@ -49,13 +76,37 @@ LEVEL_SCREEN_WIDTH = 40
 
 CHARACTER_SCREEN_WIDTH = 30
 
-color_dark_wall = libtcod.Color(0, 0, 100)
-color_light_wall = libtcod.Color(130, 110, 50)
-color_dark_ground = libtcod.Color(50, 50, 150)
-color_light_ground = libtcod.Color(200, 180, 50)
-
-class Tile:
+SIMULATION_MAX_TICKS = 100000 #a headless game that runs this long is called off
+SIMULATION_RESULTS = 'simulation_results.json'
+SPAWN_TABLES = 'spawn_tables.json'
+SAVE_FILE = 'savegame.sav'
+AUTOSAVE_INTERVAL = 1000 #game ticks between autosaves, 0 turns them off
+SAVE_JOURNAL = True #autosaves append what changed to a journal instead of rewriting the save
+JOURNAL_LIMIT = 20 #journal entries before the next autosave compacts them into a full save
+INPUT_LOG = 'input_log.json' #the inputs of the last new game, for --replay
+
+color_dark_wall = libtcod.color_get(0, 0, 100)
+color_light_wall = libtcod.color_get(130, 110, 50)
+color_dark_ground = libtcod.color_get(50, 50, 150)
+color_light_ground = libtcod.color_get(200, 180, 50)
+
+class Slotted:
+    #base for the slotted game classes. they pickle their attributes as a dict, the
+    #same state the plain classes used to save, so saves load either way
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            if name in self.__slots__: #attributes of older versions are dropped
+                setattr(self, name, value)
+
+class Tile(Slotted):
     #a tile of the map and its properties
+    __slots__ = ('blocked', 'block_sight', 'explored')
+
     def __init__(self, blocked, block_sight = None):
         self.blocked = blocked
 
@@ -65,8 +116,10 @@ class Tile:
 
         self.explored = False
 
-class Rect:
+class Rect(Slotted):
     #a rectangle on the map. used to characterize a room.
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
     def __init__(self, x, y, w, h):
         self.x1 = x
         self.y1 = y
@@ -83,7 +136,9 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
-class ConfusedMonster:
+class ConfusedMonster(Slotted):
+    __slots__ = ('owner', 'old_ai', 'num_turns')
+
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         self.old_ai = old_ai
         self.num_turns = num_turns
@@ -91,14 +146,17 @@ class ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0: #still confused...
             #move in a random direction
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.move(libtcod.random_get_int(rng, -1, 1), libtcod.random_get_int(rng, -1, 1))
             self.num_turns -= 1
         else:
-            self.owner.ai = self.old_ai
+            set_component(self.owner, 'ai', self.old_ai)
             message('The ' + self.owner.name + ' is no longer confused!', libtcod.red)
 
-class Fighter:
+class Fighter(Slotted):
     #combat related properties and methods
+    __slots__ = ('owner', 'base_max_hp', 'hp', 'base_defense', 'base_power', 'xp', 'death_function', 'attack_speed',
+                 'equipped', 'power_bonus', 'defense_bonus', 'max_hp_bonus')
+
     def __init__(self, hp, defense, power, xp, death_function=None, attack_speed=DEFAULT_ATTACK_SPEED):
         self.base_max_hp = hp
         self.hp = hp
@@ -108,39 +166,68 @@ class Fighter:
         self.death_function = death_function
         self.attack_speed = attack_speed
 
+        #what is worn, by slot, and the running totals of its bonuses
+        self.equipped = {}
+        self.power_bonus = 0
+        self.defense_bonus = 0
+        self.max_hp_bonus = 0
+
+    def __setstate__(self, state):
+        #fighters from older saves start bare, load_game puts their equipment back on
+        self.equipped = {}
+        self.power_bonus = self.defense_bonus = self.max_hp_bonus = 0
+        Slotted.__setstate__(self, state)
+
     @property
     def power(self):
-        bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_power + bonus
+        return self.base_power + self.power_bonus
 
     @property
     def defense(self):
-        bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_defense + bonus
+        return self.base_defense + self.defense_bonus
 
     @property
     def max_hp(self):
-        bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_max_hp + bonus
-
-    def take_damage(self, damage):
+        return self.base_max_hp + self.max_hp_bonus
+
+    def wear(self, equipment):
+        self.equipped[equipment.slot] = equipment
+        self.power_bonus += equipment.power_bonus
+        self.defense_bonus += equipment.defense_bonus
+        self.max_hp_bonus += equipment.max_hp_bonus
+        equipment.wearer = self
+        equipment.is_equipped = True
+
+    def take_off(self, equipment):
+        del self.equipped[equipment.slot]
+        self.power_bonus -= equipment.power_bonus
+        self.defense_bonus -= equipment.defense_bonus
+        self.max_hp_bonus -= equipment.max_hp_bonus
+        equipment.wearer = None
+        equipment.is_equipped = False
+
+    def take_damage(self, damage, source=None):
         #apply damage if possible
         if damage > 0:
             self.hp -= damage
+            publish(ON_DAMAGE, self.owner, damage, source)
         if self.hp <= 0:
+            publish(ON_DEATH, self.owner, source)
             function = self.death_function
             if function is not None:
                 function(self.owner)
             if self.owner != player:
                 player.fighter.xp += self.xp
+                publish(ON_XP_GAIN, self.xp)
 
     def attack(self, target):
         #a simple formula for attack damage
         damage = self.power - target.fighter.defense
+        make_noise(self.owner.x, self.owner.y, COMBAT_NOISE)
         if damage > 0:
             #make target take some damage
             message (self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.silver)
-            target.fighter.take_damage(damage)
+            target.fighter.take_damage(damage, self.owner)
         else:
             message (self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!', libtcod.silver)
         self.owner.wait = self.attack_speed
@@ -150,26 +237,85 @@ class Fighter:
         self.hp += amount
         if self.hp > self.max_hp:
             self.hp = self.max_hp
+        publish(ON_HEAL, self.owner, amount)
 
-class BasicMonster:
+class BasicMonster(Slotted):
     #AI for a basic monster
+    __slots__ = ('owner', 'target', 'path', 'path_revision')
+
+    def __init__(self):
+        self.target = None #where the player was last seen
+        self.path = None
+        self.path_revision = None
+
+    def __setstate__(self, state):
+        #monsters from older saves have no target or path yet
+        self.__init__()
+        Slotted.__setstate__(self, state)
+
     def take_turn(self):
         #a basic monster takes its turn. If you can see it, it can see you
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if is_in_fov(monster.x, monster.y):
+            self.target = (player.x, player.y)
+            self.path = None
 
             #move towards player if far away
             if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+                monster.move_downhill(player_distance)
 
             #close enough, attack!
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
 
-class Object:
+        elif self.target is not None:
+            #lost sight of the player, go look where it was last seen
+            self.follow_path()
+
+    def path_request(self):
+        #the (start, goal) this monster will ask for on its turn, if any, so the
+        #timeline can resolve the requests of everyone acting in one batch
+        monster = self.owner
+        if (self.target is None or is_in_fov(monster.x, monster.y) or
+            (self.path and self.path_revision == map_revision)):
+            return None
+        return ((monster.x, monster.y), self.target)
+
+    def follow_path(self):
+        monster = self.owner
+        if (not self.path or self.path_revision != map_revision or
+            max(abs(self.path[0][0] - monster.x), abs(self.path[0][1] - monster.y)) > 1):
+            #no path yet, the level changed, or something pushed us off it
+            self.path = find_path((monster.x, monster.y), self.target)
+            self.path_revision = map_revision
+            if not self.path:
+                self.target = None
+                return
+
+        (x, y) = self.path[0]
+        if is_blocked(x, y):
+            self.path = repair_path(monster, self.path)
+            if not self.path:
+                monster.wait = monster.speed #boxed in, try again later
+                return
+            (x, y) = self.path[0]
+
+        monster.move(x - monster.x, y - monster.y)
+        if (monster.x, monster.y) == (x, y):
+            del self.path[0]
+        if not self.path:
+            self.target = None #got there and the player is gone
+
+class Object(Slotted):
     #this is a generic object: the player, a monster, an item, stairs
     #it's always represented by a character on screen.
+    __slots__ = ('id', 'x', 'y', 'char', 'name', 'color', 'blocks', 'always_visible', 'speed', 'wait',
+                 'fighter', 'ai', 'item', 'equipment', #one slot per name in COMPONENTS
+                 'level', #only the player has a character level
+                 'next_turn') #set once the object is on the timeline
+
     def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, speed=DEFAULT_SPEED, item=None, equipment=None):
+        self.id = next(entity_ids)
         self.x = x
         self.y = y
         self.char = char
@@ -198,24 +344,37 @@ class Object:
             self.item = Item()
             self.item.owner = self
 
+    def __getstate__(self):
+        state = Slotted.__getstate__(self)
+        del state['id'] #ids are handed out again when loading
+        return state
+
+    def __setstate__(self, state):
+        Slotted.__setstate__(self, state)
+        self.id = next(entity_ids)
+
     def move(self, dx, dy):
         #move by the given amount, if the destination is not blocked
         if not is_blocked(self.x + dx, self.y + dy):
-            self.x += dx
-            self.y += dy
+            relocate(self, self.x + dx, self.y + dy)
         self.wait = self.speed
 
-    def move_towards(self, target_x, target_y):
-        #vector from this object to the target, and distance
-        dx = target_x - self.x
-        dy = target_y - self.y
-        distance = math.sqrt(dx ** 2 + dy ** 2)
-
-        #normalize it to length 1, preserving direction, then round it and
-        #  convert to integer so the movement is restricted to the map grid
-        dx = int(round(dx / distance))
-        dy = int(round(dy / distance))
-        self.move(dx, dy)
+    def move_downhill(self, field):
+        #step to the free neighbouring tile with the lowest value in a distance field
+        best = field[self.x + self.y * MAP_WIDTH]
+        step = None
+        for (dx, dy) in NEIGHBOURS:
+            x = self.x + dx
+            y = self.y + dy
+            value = field[x + y * MAP_WIDTH]
+            if value < best and not is_blocked(x, y):
+                best = value
+                step = (dx, dy)
+
+        if step is None:
+            self.wait = self.speed #no way closer right now, wait it out
+        else:
+            self.move(*step)
 
     def distance_to(self, other):
         #return the distance to another object
@@ -230,7 +389,7 @@ class Object:
     def draw(self):
         #set the color and then draw the character that represents this object
         # at its position, if it's in fov or is known
-        if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or
+        if (is_in_fov(self.x, self.y) or
             (self.always_visible and map[self.x][self.y].explored)):
             libtcod.console_set_default_foreground(con_map, self.color)
             libtcod.console_put_char(con_map, self.x, self.y, self.char, libtcod.BKGND_NONE)
@@ -244,8 +403,10 @@ class Object:
         objects.remove(self)
         objects.insert(0, self)
 
-class Item:
+class Item(Slotted):
     #An item that can be picked up and used.
+    __slots__ = ('owner', 'use_function')
+
     def __init__(self, use_function=None):
         self.use_function = use_function
 
@@ -259,6 +420,7 @@ class Item:
             message('The ' + self.owner.name + ' cannot be used.')
         else:
             if self.use_function() != CANCEL_USE:
+                publish(ON_ITEM_USE, self.owner)
                 inventory.remove(self.owner) #destroy after use, unless it was cancelled for some reason
 
     def pick_up(self):
@@ -267,8 +429,9 @@ class Item:
             message('Your inventory is full, cannot pick up ' + self.owner.name + '.', libtcod.red)
         else:
             inventory.append(self.owner)
-            objects.remove(self.owner)
+            remove_object(self.owner)
             message('You picked up a ' + self.owner.name + '!', libtcod.green)
+            publish(ON_PICKUP, self.owner)
             
             equipment = self.owner.equipment
             if equipment and get_equipped_in_slot(equipment.slot) is None:
@@ -278,20 +441,27 @@ class Item:
         if self.owner.equipment:
             self.owner.equipment.dequip()
         #add to the map and remove from the player's inventory.
-        objects.append(self.owner)
+        add_object(self.owner)
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
         message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 
-class Equipment:
+class Equipment(Slotted):
     #an object that can be equipped, yielding bonuses. Automatically adds the item component
+    __slots__ = ('owner', 'slot', 'power_bonus', 'defense_bonus', 'max_hp_bonus', 'is_equipped', 'wearer')
+
     def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
         self.slot = slot
         self.power_bonus = power_bonus
         self.defense_bonus = defense_bonus
         self.max_hp_bonus = max_hp_bonus
         self.is_equipped = False
+        self.wearer = None #the fighter it is equipped on
+
+    def __setstate__(self, state):
+        self.wearer = None
+        Slotted.__setstate__(self, state)
 
     def toggle_equip(self):
         if self.is_equipped:
@@ -299,20 +469,302 @@ class Equipment:
         else:
             self.equip()
 
-    def equip(self):
+    def equip(self, wearer=None):
+        #equip on a fighter, the player's by default
         if self.is_equipped: return
+        if wearer is None:
+            wearer = player.fighter
 
-        old_equipment = get_equipped_in_slot(self.slot)
+        old_equipment = wearer.equipped.get(self.slot)
         if old_equipment is not None:
             old_equipment.dequip()
 
-        self.is_equipped = True
-        message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
+        wearer.wear(self)
+        if wearer.owner == player:
+            message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
+        publish(ON_EQUIP, self, True)
 
     def dequip(self):
         if not self.is_equipped: return
-        self.is_equipped = False
-        message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
+        wearer = self.wearer
+        wearer.take_off(self)
+        if wearer.owner == player:
+            message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
+        publish(ON_EQUIP, self, False)
+
+################
+# Entity Store #
+################
+#every object on the level is also indexed by component type, so systems only
+#walk the entities that have what they need. adding a component type means a
+#new name here and a slot of the same name on Object
+COMPONENTS = ('fighter', 'ai', 'item', 'equipment')
+
+entity_ids = itertools.count()
+
+class ComponentTable(Slotted):
+    #the entities with one component type, packed densely. row i of the entities
+    #column owns row i of the components column
+    __slots__ = ('entities', 'components', 'rows')
+
+    def __init__(self):
+        self.entities = []
+        self.components = []
+        self.rows = {} #entity id -> row
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __contains__(self, entity):
+        return entity.id in self.rows
+
+    def add(self, entity, component):
+        row = self.rows.get(entity.id)
+        if row is None:
+            self.rows[entity.id] = len(self.entities)
+            self.entities.append(entity)
+            self.components.append(component)
+        else:
+            self.components[row] = component
+
+    def remove(self, entity):
+        row = self.rows.pop(entity.id, None)
+        if row is None:
+            return
+        #move the last row into the hole to keep the columns packed
+        last_entity = self.entities.pop()
+        last_component = self.components.pop()
+        if row < len(self.entities):
+            self.entities[row] = last_entity
+            self.components[row] = last_component
+            self.rows[last_entity.id] = row
+
+components = dict((name, ComponentTable()) for name in COMPONENTS)
+
+def build_components():
+    #index every object on the level from scratch
+    for name in COMPONENTS:
+        components[name] = ComponentTable()
+    fighter_cells.clear()
+    for obj in objects:
+        register_components(obj)
+
+def register_components(obj):
+    for name in COMPONENTS:
+        component = getattr(obj, name)
+        if component is not None:
+            components[name].add(obj, component)
+    if obj.fighter:
+        fighter_cells.setdefault((obj.x, obj.y), []).append(obj)
+
+def set_component(obj, name, component):
+    #give an object a component, or take it away with None
+    if name == 'fighter' and (obj in components['fighter']) != (component is not None):
+        if component is None:
+            unindex_fighter(obj)
+        else:
+            fighter_cells.setdefault((obj.x, obj.y), []).append(obj)
+    setattr(obj, name, component)
+    if component is None:
+        components[name].remove(obj)
+    else:
+        component.owner = obj
+        components[name].add(obj, component)
+
+def add_object(obj):
+    objects.append(obj)
+    register_components(obj)
+
+def remove_object(obj):
+    objects.remove(obj)
+    if obj in components['fighter']:
+        unindex_fighter(obj)
+    for name in COMPONENTS:
+        components[name].remove(obj)
+
+#################
+# Spatial Index #
+#################
+#the level's fighters bucketed by tile. queries walk a precomputed disc of
+#offsets, nearest first, so their cost depends on the area searched and not on
+#how many fighters the level holds
+fighter_cells = {} #(x, y) -> fighters standing there
+disc_offsets = {} #radius -> offsets within it, sorted by squared distance
+
+def unindex_fighter(obj):
+    cell = fighter_cells[(obj.x, obj.y)]
+    cell.remove(obj)
+    if not cell:
+        del fighter_cells[(obj.x, obj.y)]
+
+def relocate(obj, x, y):
+    #move an object, keeping the index up to date
+    indexed = obj in components['fighter']
+    if indexed:
+        unindex_fighter(obj)
+    obj.x = x
+    obj.y = y
+    if indexed:
+        fighter_cells.setdefault((x, y), []).append(obj)
+
+def disc(radius):
+    offsets = disc_offsets.get(radius)
+    if offsets is None:
+        r = int(radius)
+        offsets = [(dx, dy) for dx in range(-r, r + 1) for dy in range(-r, r + 1)
+                   if dx * dx + dy * dy <= radius * radius]
+        offsets.sort(key=lambda offset: offset[0] * offset[0] + offset[1] * offset[1])
+        disc_offsets[radius] = offsets
+    return offsets
+
+def fighter_at(x, y):
+    cell = fighter_cells.get((x, y))
+    return cell[0] if cell else None
+
+def within_radius(x, y, radius):
+    #every fighter within the radius of (x, y), nearest first
+    found = []
+    for (dx, dy) in disc(radius):
+        cell = fighter_cells.get((x + dx, y + dy))
+        if cell:
+            found.extend(cell)
+    return found
+
+def nearest(x, y, max_range, filter=None):
+    #the closest fighter within range of (x, y) that passes the filter, or None
+    for (dx, dy) in disc(max_range):
+        cell = fighter_cells.get((x + dx, y + dy))
+        if cell:
+            for obj in cell:
+                if filter is None or filter(obj):
+                    return obj
+    return None
+
+################
+# Spawn Tables #
+################
+#what can appear on a level comes from a data file. each entry's chance is a
+#from_dungeon_level table, compiled once per dungeon level into an alias table
+spawn_tables = None #the data file, loaded on first use
+compiled_spawns = {} #dungeon level -> LevelSpawns
+
+class AliasTable(Slotted):
+    #Vose's alias method: pick a column uniformly, then either keep it or take
+    #its alias, so each draw costs two random numbers whatever the table size.
+    #the weights are integers, so the thresholds are kept exact in units of 1/total
+    __slots__ = ('choices', 'keep', 'alias', 'total')
+
+    def __init__(self, choices, weights):
+        n = len(choices)
+        self.choices = choices
+        self.total = sum(weights)
+        self.keep = [self.total] * n
+        self.alias = list(range(n))
+
+        scaled = [w * n for w in weights]
+        small = [i for i in range(n) if scaled[i] < self.total]
+        large = [i for i in range(n) if scaled[i] >= self.total]
+        while small and large:
+            (less, more) = (small.pop(), large.pop())
+            self.keep[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= self.total - scaled[less]
+            if scaled[more] < self.total:
+                small.append(more)
+            else:
+                large.append(more)
+
+    def sample(self):
+        if not self.choices:
+            return None
+        column = libtcod.random_get_int(rng, 0, len(self.choices) - 1)
+        if libtcod.random_get_int(rng, 0, self.total - 1) < self.keep[column]:
+            return self.choices[column]
+        return self.choices[self.alias[column]]
+
+class LevelSpawns(Slotted):
+    __slots__ = ('monsters', 'items', 'max_monsters', 'max_items')
+
+def load_spawn_tables(path=SPAWN_TABLES):
+    global spawn_tables
+    with open(path) as file:
+        spawn_tables = json.load(file)
+    compiled_spawns.clear()
+
+def compile_template(entry):
+    #resolve the names in a data file entry to the game's colors, classes and functions
+    template = dict(entry)
+    template['color'] = getattr(libtcod, entry['color'])
+    if 'fighter' in entry:
+        fighter = dict(entry['fighter'])
+        fighter['death_function'] = globals()[fighter.pop('death')] if 'death' in fighter else None
+        template['fighter'] = fighter
+    if 'ai' in entry:
+        template['ai'] = globals()[entry['ai']]
+    if 'use' in entry:
+        template['use'] = globals()[entry['use']]
+    return template
+
+def compile_table(entries):
+    choices = []
+    weights = []
+    for key in sorted(entries):
+        chance = from_dungeon_level(entries[key]['chance'])
+        if chance > 0:
+            choices.append(compile_template(entries[key]))
+            weights.append(chance)
+    return AliasTable(choices, weights)
+
+def current_spawns():
+    #the compiled tables for the current dungeon level
+    spawns = compiled_spawns.get(dungeon_level)
+    if spawns is None:
+        if spawn_tables is None:
+            load_spawn_tables()
+        spawns = LevelSpawns()
+        spawns.monsters = compile_table(spawn_tables['monsters'])
+        spawns.items = compile_table(spawn_tables['items'])
+        spawns.max_monsters = from_dungeon_level(spawn_tables['max monsters'])
+        spawns.max_items = from_dungeon_level(spawn_tables['max items'])
+        compiled_spawns[dungeon_level] = spawns
+    return spawns
+
+def spawn(template):
+    #a new object built from a compiled template, or None for an empty table
+    if template is None:
+        return None
+    fighter_component = None
+    if 'fighter' in template:
+        fighter_component = Fighter(**template['fighter'])
+    ai_component = template['ai']() if 'ai' in template else None
+    item_component = Item(use_function=template['use']) if 'use' in template else None
+    equipment_component = Equipment(**template['equipment']) if 'equipment' in template else None
+    return Object(0, 0, template['char'], template['name'], template['color'], blocks=template.get('blocks', False),
+                  fighter=fighter_component, ai=ai_component, item=item_component, equipment=equipment_component)
+
+#############
+# Event Bus #
+#############
+#game events, published with the arguments noted next to each
+ON_DAMAGE = 'damage' #(object, damage, source object or None)
+ON_HEAL = 'heal' #(object, amount)
+ON_DEATH = 'death' #(object, source object or None)
+ON_XP_GAIN = 'xp gain' #(amount)
+ON_LEVEL_UP = 'level up' #(new character level)
+ON_PICKUP = 'pickup' #(item object)
+ON_ITEM_USE = 'item use' #(item object)
+ON_EQUIP = 'equip' #(equipment component, True when equipped and False when removed)
+ON_LEVEL_CHANGE = 'level change' #(new dungeon level)
+ON_MESSAGE = 'message' #(line, color)
+
+subscribers = {}
+
+def subscribe(event, handler):
+    subscribers.setdefault(event, []).append(handler)
+
+def publish(event, *args):
+    for handler in subscribers.get(event, ()):
+        handler(*args)
 
 def create_room(room):
     global map
@@ -335,7 +787,7 @@ def create_v_tunnel(y1, y2, x):
         map[x][y].block_sight = False
 
 def make_map():
-    global map, objects, stairs
+    global map, objects, stairs, visibility, rooms
 
     objects = [player]
 
@@ -349,11 +801,11 @@ def make_map():
 
     for r in range(MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
 
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -387,7 +839,7 @@ def make_map():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
             
                 #flip a coin
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng, 0, 1) == 1:
                    #first move horizontally, then vertically 
                    create_h_tunnel(prev_x, new_x, prev_y)
                    create_v_tunnel(prev_y, new_y, new_x)
@@ -400,78 +852,19 @@ def make_map():
             rooms.append(new_room)
             num_rooms += 1
     stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white, always_visible=True)
-    objects.append(stairs)
+    add_object(stairs)
     stairs.send_to_back()
 
-def random_monster():
-    monster_chances = {}
-    monster_chances['orc'] = 80
-    monster_chances['troll'] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
-
-    choice = random_choice(monster_chances)
-
-    if choice == 'orc': #80% chance of getting an orc
-        #create an orc
-        fighter_component = Fighter(hp=20, defense=0, power=4, xp=35, death_function=monster_death)
-        ai_component = BasicMonster()
-        return Object(0, 0, 'o', 'Orc', libtcod.desaturated_green, 
-                            blocks = True, fighter = fighter_component, ai = ai_component)
-    elif choice == 'troll':
-        #create a troll
-        fighter_component = Fighter(hp=30, defense=2, power=8, xp=100, death_function=monster_death)
-        ai_component = BasicMonster()
-        return Object(0, 0, 'T', 'Troll', libtcod.darker_green, blocks = True, 
-                            fighter = fighter_component, ai = ai_component)
+    if PRECOMPUTE_VISIBILITY:
+        build_visibility()
+    else:
+        visibility = None
 
+def random_monster():
+    return spawn(current_spawns().monsters.sample())
 
 def random_item():
-    item_chances = {}
-
-    item_chances['heal'] = 35
-    item_chances['lightning'] = from_dungeon_level([[25, 4]])
-    item_chances['fireball'] = from_dungeon_level([[25, 6]])
-    item_chances['confuse'] = from_dungeon_level([[10, 2]])
-    item_chances['sword'] = from_dungeon_level([[10, 3]])
-    item_chances['shield'] = from_dungeon_level([[10, 6]])
-
-    choice = random_choice(item_chances)
-
-    if choice == 'heal':
-        item_component = Item(use_function=cast_heal)
-        return Object(0, 0, '!', 'healing potion', libtcod.violet, item=item_component)
-    elif choice == 'confuse':
-        item_component = Item(use_function=cast_confuse)
-        return Object(0, 0, '#', 'scroll of confusion', libtcod.light_yellow, item=item_component)
-    elif choice == 'fireball':
-        item_component = Item(use_function=cast_fireball)
-        return Object(0, 0, '#', 'scroll of fireball', libtcod.light_yellow, item=item_component)
-    elif choice == 'confuse':
-        item_component = Item(use_function=cast_lightning)
-        return Object(0, 0, '#', 'scroll of lightning bolt', libtcod.light_yellow, item=item_component)
-    elif choice == 'sword':
-        equipment_component = Equipment(slot='right hand', power_bonus=3)
-        return Object(0, 0, '/', 'sword', libtcod.sky, equipment=equipment_component)
-    elif choice == 'shield':
-        equipment_component = Equipment(slot='left hand', defense_bonus=1)
-        return Object(0, 0, '[', 'shield', libtcod.sky, equipment=equipment_component)
-
-def random_choice_index(chances):#choose one option from a list of choices, returning the index
-    #the dice will land on some number between 1 and the sum of the chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
-
-    running_sum = 0
-    choice = 0
-    for w in chances:
-        running_sum += w
-        if dice <= running_sum:
-            return choice
-        choice += 1
-
-def random_choice(chances_dict):
-    chances = chances_dict.values()
-    strings = list(chances_dict.keys())
-    choice = random_choice_index(chances)
-    return strings[choice]
+    return spawn(current_spawns().items.sample())
 
 def from_dungeon_level(table):
     #returns a value that depends on level. the table specifies what value occurs after each level
@@ -488,27 +881,17 @@ def next_level():
     message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', libtcod.red)
     dungeon_level += 1
     make_map()
-    initialize_fov()
-
-def get_all_equipped(obj):
-    if obj == player:
-        equipped_list = []
-        for item in inventory:
-            if item.equipment and item.equipment.is_equipped:
-                equipped_list.append(item.equipment)
-        return equipped_list
-    else:
-        return [] #nothing on anything else yet
+    initialize_level()
+    publish(ON_LEVEL_CHANGE, dungeon_level)
 
 def get_equipped_in_slot(slot): #returns the equipment in a slot, or None if empty
-    for obj in inventory:
-        if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-            return obj.equipment
-    return None
+    return player.fighter.equipped.get(slot)
 
 def target_tile(max_range=None):
     #return the position of a tile left-clicked in player's FOV (optionally in a range), or (None, None) if right-clicked
     global key, mouse
+    if bot is not None:
+        return bot.choose_target(max_range)
     while True:
         #render the screen. this erases the inventory and shows the names of objects under the mouse
         libtcod.console_flush()
@@ -517,29 +900,35 @@ def target_tile(max_range=None):
 
         (x, y) = (mouse.cx, mouse.cy)
 
-        if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and
+        if (mouse.lbutton_pressed and is_in_fov(x, y) and
             (max_range is None or player.distance(x, y) <= max_range)):
+            record_input('target', (x, y))
             return (x, y)
 
         if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
+            record_input('target', (None, None))
             return (None, None) #cancel
 
 def closest_monster(max_range):
     #find closest enemy, up to a maximum range, within player's POV
-    closest_enemy = None
-    closest_dist = max_range+1
-    for object in objects:
-        if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
-            dist = player.distance_to(object)
-            if dist < closest_dist:
-                closest_enemy = object
-                closest_dist = dist
-    return closest_enemy
+    return nearest(player.x, player.y, max_range,
+                   lambda object: object is not player and is_in_fov(object.x, object.y))
+
+level_up_pending = False #only look at the XP threshold after XP was gained
+
+def queue_level_up_check(amount):
+    global level_up_pending
+    level_up_pending = True
+
+subscribe(ON_XP_GAIN, queue_level_up_check)
 
 def check_level_up():
+    global level_up_pending
+    level_up_pending = False
     level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
     
     if player.fighter.xp >= level_up_xp:
+        level_up_pending = True #there may be enough XP left for another level
         player.level += 1
         player.fighter.xp -= level_up_xp
         message('Your battle skills grow stronger! You reached level ' + str(player.level) + '!', libtcod.yellow)
@@ -558,22 +947,21 @@ def check_level_up():
                 player.fighter.base_power += 1
             elif choice == 2:
                 player.fighter.base_defense += 1
+        publish(ON_LEVEL_UP, player.level)
 
 def player_move_or_attack(dx, dy):
     global fov_recompute
     x = player.x + dx
     y = player.y + dy
 
-    target = None
-    for object in objects:
-        if object.fighter and object.x == x and object.y == y:
-            target = object
-            break
+    target = fighter_at(x, y)
     if target is not None:
         player.fighter.attack(target)
     else:
         player.move(dx, dy)
         fov_recompute = True
+        update_player_distance()
+        wake_near_player()
 
 def cast_heal():
     #heal the player
@@ -603,8 +991,7 @@ def cast_confuse():
     #zap it!
     message('The eyes of the ' + monster.name + ' look vacant as he stumbles around.', libtcod.light_green)
     old_ai = monster.ai
-    monster.ai = ConfusedMonster(old_ai)
-    monster.ai.owner = monster
+    set_component(monster, 'ai', ConfusedMonster(old_ai))
 
 def cast_fireball():
     #ask the player for a target tile to throw a fireball at
@@ -613,8 +1000,8 @@ def cast_fireball():
     if x is None: return CANCEL_USE
     message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles.', libtcod.orange)
 
-    for obj in objects: #damage every fighter in range, including the player
-        if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
+    for obj in within_radius(x, y, FIREBALL_RADIUS): #damage every fighter in range, including the player
+        if obj.fighter:
             message('The ' + obj.name + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.orange)
             obj.fighter.take_damage(FIREBALL_DAMAGE)
 
@@ -631,42 +1018,42 @@ def monster_death(monster):
     monster.char = '%'
     monster.color = libtcod.dark_red
     monster.blocks = False
-    monster.fighter = None
-    monster.ai = None
+    set_component(monster, 'fighter', None)
+    set_component(monster, 'ai', None)
     monster.name = 'remains of ' + monster.name
     monster.send_to_back()
 
 def place_objects(room):
     #choose ramdom number of monsters
-    max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)    
+    max_monsters = current_spawns().max_monsters
+    num_monsters = libtcod.random_get_int(rng, 0, max_monsters)    
 
     for i in range(num_monsters):
         #choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+        y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
 
         if not is_blocked(x, y):
             monster = random_monster()
             if not monster == None:
                 monster.x = x
                 monster.y = y
-                objects.append(monster)
+                add_object(monster)
 
     #place a random number of items
-    max_items = from_dungeon_level([[1, 1], [2, 4]])
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    max_items = current_spawns().max_items
+    num_items = libtcod.random_get_int(rng, 0, max_items)
 
     for i in range(num_items):
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+        y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
 
         if not is_blocked(x, y):
             item = random_item()
             if not item == None:
                 item.x = x
                 item.y = y
-                objects.append(item)
+                add_object(item)
                 item.send_to_back()
 
 def is_blocked(x, y):
@@ -681,10 +1068,521 @@ def is_blocked(x, y):
 
     return False
 
+###################
+# Distance Fields #
+###################
+UNREACHABLE = float('inf')
+#orthogonal steps first, so ties in a field prefer them over diagonals
+NEIGHBOURS = [(0, -1), (-1, 0), (1, 0), (0, 1), (-1, -1), (1, -1), (-1, 1), (1, 1)]
+
+player_distance = None #shared "steps to the player" field for every chasing monster
+
+def distance_field(goals):
+    #flood the walkable plane outwards from every goal at once. goals are
+    #(x, y, value) seeds: plain goals start at 0, flee maps seed other values.
+    #the result is a flat list indexed by x + y * MAP_WIDTH
+    if numpy_available:
+        return distance_field_numpy(goals)
+
+    field = [UNREACHABLE] * (MAP_WIDTH * MAP_HEIGHT)
+    frontier = []
+    for (x, y, value) in goals:
+        i = x + y * MAP_WIDTH
+        if value < field[i]:
+            field[i] = value
+            frontier.append((value, i))
+    heapq.heapify(frontier)
+
+    while frontier:
+        (value, i) = heapq.heappop(frontier)
+        if value > field[i]:
+            continue #already reached more cheaply
+        x = i % MAP_WIDTH
+        y = i // MAP_WIDTH
+        value += 1
+        for (dx, dy) in NEIGHBOURS:
+            nx = x + dx
+            ny = y + dy
+            if 0 <= nx < MAP_WIDTH and 0 <= ny < MAP_HEIGHT and not map[nx][ny].blocked:
+                j = nx + ny * MAP_WIDTH
+                if value < field[j]:
+                    field[j] = value
+                    heapq.heappush(frontier, (value, j))
+    return field
+
+def distance_field_numpy(goals):
+    #the same flood a ring at a time: every tile that improved last step offers
+    #one more than its value to its walkable neighbours, all in one go, until
+    #none improves. the values come out the same as the heap's
+    stride = MAP_WIDTH + 2 #a border of unwalkable tiles keeps every neighbour in range
+    walkable = numpy.zeros((MAP_HEIGHT + 2, stride), dtype=bool)
+    walkable[1:-1, 1:-1] = ~current_blocked_plane().reshape(MAP_HEIGHT, MAP_WIDTH)
+    walkable = walkable.ravel()
+    field = numpy.full(walkable.size, UNREACHABLE)
+    for (x, y, value) in goals:
+        i = x + 1 + (y + 1) * stride
+        field[i] = min(field[i], value)
+    steps = numpy.array([dx + dy * stride for (dx, dy) in NEIGHBOURS])
+
+    frontier = numpy.flatnonzero(field < UNREACHABLE)
+    while len(frontier):
+        targets = (frontier[:, numpy.newaxis] + steps).ravel()
+        values = numpy.repeat(field[frontier] + 1, len(steps))
+        better = walkable[targets] & (values < field[targets])
+        (targets, values) = (targets[better], values[better])
+        numpy.minimum.at(field, targets, values) #the lowest offer wins where several meet
+        frontier = numpy.unique(targets)
+    return field.reshape(MAP_HEIGHT + 2, stride)[1:-1, 1:-1].ravel().tolist()
+
+def flee_field(field):
+    #rescan a goal field from its scaled, negated values. walking downhill on the
+    #result leads away from the goals without running into dead ends
+    return distance_field([(i % MAP_WIDTH, i // MAP_WIDTH, FLEE_FACTOR * value)
+                           for (i, value) in enumerate(field) if value != UNREACHABLE])
+
+def update_player_distance():
+    #computed once per player move and shared by every monster chasing the player
+    global player_distance, distance_plane
+    player_distance = distance_field([(player.x, player.y, 0)])
+    distance_plane = None
+
+###############
+# Pathfinding #
+###############
+map_revision = 0 #bumped whenever the tiles change, invalidating cached paths
+path_cache = {} #(start, goal, map_revision) -> list of steps, or None if unreachable
+path_map = None #walkability the A* search runs on, a copy of fov_map
+path_finder = None
+
+def initialize_paths():
+    global map_revision, path_map, path_finder
+    if path_finder is not None:
+        libtcod.path_delete(path_finder)
+        libtcod.map_delete(path_map)
+
+    map_revision += 1
+    path_cache.clear()
+    path_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+    libtcod.map_copy(fov_map, path_map)
+    #searching a libtcod map keeps the whole A* in C, unlike path_new_using_function
+    path_finder = libtcod.path_new_using_map(path_map)
+
+def compute_path(start, goal):
+    if not libtcod.path_compute(path_finder, start[0], start[1], goal[0], goal[1]):
+        return None
+    return [libtcod.path_get(path_finder, i) for i in range(libtcod.path_size(path_finder))]
+
+def find_paths(requests):
+    #resolve a batch of (start, goal) requests against the tiles only, computing
+    #each distinct one at most once per map revision. moving blockers are left
+    #to repair_path, so cached paths stay valid while monsters shuffle around
+    paths = []
+    for (start, goal) in requests:
+        key = (start, goal, map_revision)
+        if key not in path_cache:
+            if len(path_cache) >= PATH_CACHE_SIZE:
+                del path_cache[next(iter(path_cache))] #drop the oldest entry
+            path_cache[key] = compute_path(start, goal)
+        paths.append(path_cache[key])
+    return paths
+
+def find_path(start, goal):
+    #returns a fresh list of steps the caller may consume, or None
+    path = find_paths([(start, goal)])[0]
+    return list(path) if path is not None else None
+
+def repair_path(obj, path):
+    #something blocks the next step: detour around it and rejoin the path a few
+    #steps further along, with every blocking object treated as a wall
+    blockers = [other for other in objects if other.blocks and other is not obj and
+                max(abs(other.x - obj.x), abs(other.y - obj.y)) <= PATH_REPAIR_LOOKAHEAD + 1]
+    occupied = set((other.x, other.y) for other in blockers)
+    for other in blockers:
+        libtcod.map_set_properties(path_map, other.x, other.y, not map[other.x][other.y].block_sight, False)
+
+    detour = None
+    for rejoin in range(min(PATH_REPAIR_LOOKAHEAD, len(path) - 1), len(path)):
+        if path[rejoin] not in occupied:
+            detour = compute_path((obj.x, obj.y), path[rejoin])
+            break
+
+    for other in blockers:
+        libtcod.map_set_properties(path_map, other.x, other.y,
+                                   not map[other.x][other.y].block_sight, not map[other.x][other.y].blocked)
+
+    if detour is None:
+        return None
+    return detour + path[rejoin + 1:]
+
+##################
+# Actor Timeline #
+##################
+timeline = [] #heap of (tick, order, object), one live entry per scheduled actor
+timeline_order = itertools.count() #tie-breaker so actors due on the same tick keep FIFO order
+game_tick = 0
+
+def schedule_turn(obj, delay):
+    #(re)schedule an actor to act 'delay' ticks from now. any entry it already
+    #has in the heap goes stale and is skipped when it comes up
+    obj.next_turn = game_tick + delay
+    heapq.heappush(timeline, (obj.next_turn, next(timeline_order), obj))
+
+def initialize_timeline():
+    global timeline, player_room
+    timeline = []
+    sleeping.clear()
+    dormant_sectors.clear()
+    player_room = None
+    for obj in components['ai'].entities:
+        schedule_turn(obj, obj.wait)
+
+def run_timeline():
+    #advance one tick and wake only the actors that are due on it
+    global game_tick
+    game_tick += 1
+    due = []
+    while timeline and timeline[0][0] <= game_tick:
+        (tick, order, obj) = heapq.heappop(timeline)
+        if obj.ai is None or tick != obj.next_turn:
+            continue #dead, or rescheduled since this entry was pushed
+        if is_dormant(obj):
+            fall_asleep(obj) #out of the timeline until something wakes it
+        else:
+            due.append(obj)
+
+    #resolve the path requests of everyone acting this tick in one batch
+    requests = [obj.ai.path_request() for obj in due if hasattr(obj.ai, 'path_request')]
+    find_paths([request for request in requests if request is not None])
+
+    #whatever an actor does sets its wait (speed, attack speed...)
+    for obj in due:
+        obj.wait = 0
+
+    acted = due
+    if batch_ai_active():
+        batch = [obj for obj in due if obj.ai.__class__ is BasicMonster]
+        due = [obj for obj in due if obj.ai.__class__ is not BasicMonster]
+        if batch:
+            batch_take_turns(batch)
+
+    for obj in due:
+        if obj.ai is not None: #could have been killed earlier in this tick
+            obj.ai.take_turn()
+
+    for obj in acted:
+        if obj.ai:
+            schedule_turn(obj, obj.wait + 1)
+
+############
+# Batch AI #
+############
+#NumPy copies of the level, the FOV and the player distance field, built on
+#first use by the batch AI or the distance fields and dropped whenever the
+#source changes
+fov_plane = None
+blocked_plane = None
+distance_plane = None
+
+def batch_ai_active():
+    return BATCH_AI and numpy_available
+
+def current_fov_plane():
+    global fov_plane
+    if fov_plane is None:
+        if visible_cells is not None:
+            bits = numpy.unpackbits(numpy.frombuffer(bytes(visible_cells), dtype=numpy.uint8), bitorder='little')
+            fov_plane = bits[:MAP_WIDTH * MAP_HEIGHT].astype(bool)
+        else:
+            fov_plane = numpy.array([libtcod.map_is_in_fov(fov_map, i % MAP_WIDTH, i // MAP_WIDTH)
+                                     for i in range(MAP_WIDTH * MAP_HEIGHT)], dtype=bool)
+    return fov_plane
+
+def current_blocked_plane():
+    global blocked_plane
+    if blocked_plane is None:
+        blocked_plane = numpy.array([map[i % MAP_WIDTH][i // MAP_WIDTH].blocked
+                                     for i in range(MAP_WIDTH * MAP_HEIGHT)], dtype=bool)
+    return blocked_plane
+
+def current_distance_plane():
+    global distance_plane
+    if distance_plane is None:
+        distance_plane = numpy.array(player_distance, dtype=float)
+    return distance_plane
+
+def batch_take_turns(monsters):
+    #BasicMonster.take_turn for a whole list of monsters in one vectorized pass.
+    #the ones that see the player attack or step downhill together, and the rest
+    #fall back to take_turn. this only approximates calling take_turn in turn
+    #order: every mover picks its tile against the occupancy at the start of the
+    #pass, so a tile freed by an earlier mover stays blocked for the rest of it,
+    #and a mover that loses its tile to an earlier one waits instead of taking
+    #its next best free tile
+    xs = numpy.array([monster.x for monster in monsters])
+    ys = numpy.array([monster.y for monster in monsters])
+    cells = xs + ys * MAP_WIDTH
+    visible = current_fov_plane()[cells]
+
+    for i in numpy.flatnonzero(~visible):
+        monsters[i].ai.take_turn()
+
+    dx = player.x - xs
+    dy = player.y - ys
+    attacking = numpy.flatnonzero(visible & (dx * dx + dy * dy < 4)) #distance_to(player) < 2
+    chasing = numpy.flatnonzero(visible & (dx * dx + dy * dy >= 4))
+
+    for i in numpy.flatnonzero(visible):
+        monsters[i].ai.target = (player.x, player.y)
+        monsters[i].ai.path = None
+
+    for i in attacking:
+        if player.fighter.hp > 0:
+            monsters[i].fighter.attack(player)
+
+    if len(chasing) == 0:
+        return
+
+    #tiles taken by walls or any blocking object, as is_blocked would say
+    occupied = current_blocked_plane().copy()
+    occupied[[obj.x + obj.y * MAP_WIDTH for obj in objects if obj.blocks]] = True
+
+    field = current_distance_plane()
+    here = cells[chasing]
+    steps = numpy.array([dx + dy * MAP_WIDTH for (dx, dy) in NEIGHBOURS])
+    targets = here[numpy.newaxis, :] + steps[:, numpy.newaxis] #one row per direction
+    values = numpy.where(occupied[targets], UNREACHABLE, field[targets])
+    best = values.argmin(axis=0) #first minimum, so orthogonal steps win ties
+    columns = numpy.arange(len(chasing))
+    target = targets[best, columns]
+    moving = numpy.flatnonzero(values[best, columns] < field[here])
+
+    #several movers can want the same tile: the first in turn order gets it and
+    #the others wait this turn out
+    (unused, first) = numpy.unique(target[moving], return_index=True)
+    for j in moving[first]:
+        relocate(monsters[chasing[j]], int(target[j] % MAP_WIDTH), int(target[j] // MAP_WIDTH))
+
+    for i in chasing:
+        monsters[i].wait = monsters[i].speed #moved or waited it out, like move_downhill
+
+def benchmark_ai():
+    #time one AI step for growing crowds in an open arena, calling take_turn per
+    #monster versus the batch pass
+    global MAP_WIDTH, MAP_HEIGHT, TORCH_RANGE, map, objects, player, game_msgs, con_map
+    MAP_WIDTH = MAP_HEIGHT = 200
+    TORCH_RANGE = 0 #light the whole arena so every monster is awake and chasing
+    con_map = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    map = [[Tile(x in (0, MAP_WIDTH - 1) or y in (0, MAP_HEIGHT - 1))
+        for y in range(MAP_HEIGHT)]
+            for x in range(MAP_WIDTH)]
+    game_msgs = []
+
+    print('%-10s %14s %14s' % ('monsters', 'per monster', 'batch'))
+    for count in (10, 100, 1000, 10000):
+        fighter_component = Fighter(hp=10 ** 9, defense=0, power=0, xp=0)
+        player = Object(MAP_WIDTH // 2, MAP_HEIGHT // 2, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+        taken = set([(player.x, player.y)])
+        while len(taken) <= count:
+            taken.add((libtcod.random_get_int(0, 1, MAP_WIDTH - 2), libtcod.random_get_int(0, 1, MAP_HEIGHT - 2)))
+        taken.remove((player.x, player.y))
+        monsters = [Object(x, y, 'o', 'Orc', libtcod.desaturated_green, blocks=True,
+                           fighter=Fighter(hp=20, defense=0, power=4, xp=35, death_function=monster_death), ai=BasicMonster())
+                    for (x, y) in taken]
+        objects = [player] + monsters
+        initialize_level()
+        recompute_fov()
+        start_positions = [(monster.x, monster.y) for monster in monsters]
+
+        single = None
+        if count <= 1000: #the per-monster path is quadratic, too slow beyond this
+            start = time.time()
+            for monster in monsters:
+                monster.ai.take_turn()
+            single = time.time() - start
+            for (monster, (x, y)) in zip(monsters, start_positions):
+                relocate(monster, x, y)
+
+        batch = None
+        if numpy_available:
+            #the planes are rebuilt once per player move, not once per tick
+            current_fov_plane()
+            current_blocked_plane()
+            current_distance_plane()
+            start = time.time()
+            batch_take_turns(monsters)
+            batch = time.time() - start
+
+        print('%-10d %14s %14s' % (count, '-' if single is None else '%.4fs' % single,
+                                   '-' if batch is None else '%.4fs' % batch))
+
+############
+# Dormancy #
+############
+sleeping = {} #sleeping monster -> its sector
+dormant_sectors = {} #sector -> list of monsters sleeping there
+rooms = []
+player_room = None
+
+def is_dormant(obj):
+    #far from the player, out of sight and not hunting anything
+    dx = obj.x - player.x
+    dy = obj.y - player.y
+    return (dx * dx + dy * dy > ACTIVATION_RADIUS * ACTIVATION_RADIUS and
+            getattr(obj.ai, 'target', None) is None and not is_in_fov(obj.x, obj.y))
+
+def fall_asleep(obj):
+    sector = (obj.x // SECTOR_SIZE, obj.y // SECTOR_SIZE)
+    sleeping[obj] = sector
+    dormant_sectors.setdefault(sector, []).append(obj)
+
+def wake(obj):
+    #put a sleeping monster back in the timeline; anything else is left alone
+    sector = sleeping.pop(obj, None)
+    if sector is not None:
+        dormant_sectors[sector].remove(obj)
+        schedule_turn(obj, 1)
+
+def wake_on_damage(obj, damage, source):
+    wake(obj)
+
+subscribe(ON_DAMAGE, wake_on_damage)
+
+def wake_area(x1, y1, x2, y2, radius=None):
+    #wake the sleepers inside a rectangle, or inside the circle it bounds if a
+    #radius is given. only the sectors overlapping the area are looked at
+    cx = (x1 + x2) / 2
+    cy = (y1 + y2) / 2
+    for sx in range(x1 // SECTOR_SIZE, x2 // SECTOR_SIZE + 1):
+        for sy in range(y1 // SECTOR_SIZE, y2 // SECTOR_SIZE + 1):
+            for obj in list(dormant_sectors.get((sx, sy), ())):
+                if not (x1 <= obj.x <= x2 and y1 <= obj.y <= y2):
+                    continue
+                if radius is None or (obj.x - cx) ** 2 + (obj.y - cy) ** 2 <= radius * radius:
+                    wake(obj)
+
+def make_noise(x, y, radius):
+    if sleeping:
+        wake_area(x - radius, y - radius, x + radius, y + radius, radius)
+
+def wake_near_player():
+    #called when the player moves: wake whatever is inside the activation
+    #radius, and everything in a room the player just walked into
+    global player_room
+    if not sleeping:
+        return
+    wake_area(player.x - ACTIVATION_RADIUS, player.y - ACTIVATION_RADIUS,
+              player.x + ACTIVATION_RADIUS, player.y + ACTIVATION_RADIUS, ACTIVATION_RADIUS)
+
+    room = None
+    for other in rooms:
+        if other.x1 < player.x < other.x2 and other.y1 < player.y < other.y2:
+            room = other
+            break
+    if room is not None and room is not player_room:
+        wake_area(room.x1, room.y1, room.x2, room.y2)
+    player_room = room
+
+############################
+# Potentially Visible Sets #
+############################
+visibility = None #(x, y) -> compressed bitset of the tiles visible from there
+visible_cells = None #decompressed bitset for the player's current tile
+
+def is_in_fov(x, y):
+    #FOV test used by the player, monsters and rendering alike
+    if visible_cells is not None:
+        if x < 0 or y < 0 or x >= MAP_WIDTH or y >= MAP_HEIGHT:
+            return False
+        i = x + y * MAP_WIDTH
+        return (visible_cells[i >> 3] & (1 << (i & 7))) != 0
+    return libtcod.map_is_in_fov(fov_map, x, y)
+
+def visibility_chunk(args):
+    #runs in a worker process: rebuild a private FOV map from the transparency
+    #plane and compute the compressed visible set of every origin in the chunk
+    (width, height, transparent, origins) = args
+    fov = libtcod.map_new(width, height)
+    for y in range(height):
+        for x in range(width):
+            libtcod.map_set_properties(fov, x, y, transparent[x + y * width], True)
+
+    radius = TORCH_RANGE or max(width, height)
+    sets = []
+    for (ox, oy) in origins:
+        libtcod.map_compute_fov(fov, ox, oy, TORCH_RANGE, FOV_LIGHT_WALLS, FOV_ALGO)
+        bits = bytearray((width * height + 7) // 8)
+        #nothing outside the torch radius is lit, so only scan its bounding box
+        for y in range(max(0, oy - radius), min(height, oy + radius + 1)):
+            for x in range(max(0, ox - radius), min(width, ox + radius + 1)):
+                if libtcod.map_is_in_fov(fov, x, y):
+                    i = x + y * width
+                    bits[i >> 3] |= 1 << (i & 7)
+        sets.append(((ox, oy), zlib.compress(bytes(bits))))
+    libtcod.map_delete(fov)
+    return sets
+
+def compute_visibility(width, height, transparent, walkable):
+    #split the walkable tiles into chunks and farm them out to a process pool
+    origins = [(x, y) for y in range(height) for x in range(width) if walkable[x + y * width]]
+    chunks = [(width, height, transparent, origins[i:i + VISIBILITY_CHUNK])
+              for i in range(0, len(origins), VISIBILITY_CHUNK)]
+
+    sets = {}
+    pool = multiprocessing.Pool()
+    try:
+        for chunk in pool.imap_unordered(visibility_chunk, chunks):
+            sets.update(chunk)
+    finally:
+        pool.close()
+        pool.join()
+    return sets
+
+def build_visibility():
+    global visibility
+    transparent = bytes(not map[x][y].block_sight for y in range(MAP_HEIGHT) for x in range(MAP_WIDTH))
+    walkable = bytes(not map[x][y].blocked for y in range(MAP_HEIGHT) for x in range(MAP_WIDTH))
+    visibility = compute_visibility(MAP_WIDTH, MAP_HEIGHT, transparent, walkable)
+
+def benchmark_visibility():
+    #report build time and memory of the visible sets for a few level sizes
+    print('%-10s %8s %10s %12s' % ('size', 'floor', 'seconds', 'bytes'))
+    for scale in (1, 2, 4):
+        width = MAP_WIDTH * scale
+        height = MAP_HEIGHT * scale
+        #an open cave with random pillars, walled in on the borders
+        walkable = bytearray(width * height)
+        for y in range(1, height - 1):
+            for x in range(1, width - 1):
+                walkable[x + y * width] = libtcod.random_get_int(0, 0, 9) > 0
+        transparent = bytes(walkable)
+
+        start = time.time()
+        sets = compute_visibility(width, height, transparent, bytes(walkable))
+        elapsed = time.time() - start
+        size = sum(len(bits) for bits in sets.values())
+        print('%-10s %8d %10.2f %12d' % ('%dx%d' % (width, height), len(sets), elapsed, size))
+
 ################
 # Status Panel #
 ################
 con_status = libtcod.console_new(PANEL_WIDTH, PANEL_HEIGHT)
+con_map = None #created along with the root console, or by a headless run
+map_buffer = None #the map's backgrounds, drawn here then sent to con_map in one fill
+status_dirty = True #the panel is only redrawn after an event that changes it
+status_names = None #the names under the mouse it was last drawn with
+
+def mark_status_dirty(*args):
+    global status_dirty
+    status_dirty = True
+
+def player_status_changed(obj, *args):
+    if obj == player:
+        mark_status_dirty()
+
+for event in (ON_MESSAGE, ON_EQUIP, ON_LEVEL_UP, ON_LEVEL_CHANGE):
+    subscribe(event, mark_status_dirty)
+for event in (ON_DAMAGE, ON_HEAL):
+    subscribe(event, player_status_changed)
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     #render a bar (HP, experience, etc). First calculate the width of the bar
@@ -708,6 +1606,8 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 
 def menu(header, options, width):
     if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
+    if bot is not None:
+        return bot.choose(header, options)
     #calculate the total height for the header (after auto-wrap) and one line per option
     header_height = libtcod.console_get_height_rect(con_map, 0, 0, width, SCREEN_HEIGHT, header)
     if header == '':
@@ -743,8 +1643,9 @@ def menu(header, options, width):
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
     #convert the ASCII code to an index; if it corresponds to an option, return it
     index = key.c - ord('a')
-    if index >= 0 and index < len(options): return index
-    return None
+    if index < 0 or index >= len(options): index = None
+    record_input('menu', index)
+    return index
 
 def inventory_menu(header):
     #show a menu with each item of the inventory as an option
@@ -787,12 +1688,21 @@ def main_menu():
         choice = menu('', ['Play a new game', 'Continue last game', 'Quit'], 24)
 
         if choice == 0:
-            new_game()
-            play_game()
+            #seed every new game so its input log can replay it
+            seed = int(time.time())
+            start_recording(seed)
+            try:
+                new_game(seed)
+                play_game()
+            finally:
+                #closing the window or crashing leaves the loop too, and a
+                #crash is the game most worth replaying
+                save_recording()
 
         elif choice == 1:
             try:
                 load_game()
+                stop_recording() #a loaded game cannot be replayed from its seed
             except:
                 msgbox('\n No saved game to load. \n', 24)
                 continue
@@ -815,6 +1725,7 @@ def message(new_msg, color = libtcod.white):
             del game_msgs[0]
 
         game_msgs.append((line, color))
+        publish(ON_MESSAGE, line, color)
 
 ##################
 # Main Functions #
@@ -825,7 +1736,7 @@ def get_names_under_mouse():
     (x, y) = (mouse.cx, mouse.cy)
 
     names = [obj.name for obj in objects 
-             if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, x, y)]
+             if obj.x == x and obj.y == y and is_in_fov(x, y)]
     
     names = ', '.join(names)
     return names.capitalize()
@@ -833,7 +1744,8 @@ def get_names_under_mouse():
 def handle_keys():
     global fov_recompute, mouse, key
 
-    check_level_up()
+    if level_up_pending:
+        check_level_up()
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         #Alt+Enter: toggle fullscreen
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
@@ -846,92 +1758,104 @@ def handle_keys():
             player.wait -= 1
             return
 
-        #movement keys
-        if libtcod.console_is_key_pressed(libtcod.KEY_UP) or key.vk == libtcod.KEY_KP8:
-            player_move_or_attack(0, -1)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_DOWN) or key.vk == libtcod.KEY_KP2:
-            player_move_or_attack(0, 1)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_LEFT) or key.vk == libtcod.KEY_KP4:
-            player_move_or_attack(-1, 0)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_RIGHT) or key.vk == libtcod.KEY_KP6:
-            player_move_or_attack(1, 0)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_HOME) or key.vk == libtcod.KEY_KP7:
-            player_move_or_attack(-1, -1)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_PAGEUP) or key.vk == libtcod.KEY_KP9:
-            player_move_or_attack(1, -1)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_END) or key.vk == libtcod.KEY_KP1:
-            player_move_or_attack(-1, 1)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_PAGEDOWN) or key.vk == libtcod.KEY_KP3:
-            player_move_or_attack(1, 1)
-        elif libtcod.console_is_key_pressed(libtcod.KEY_KP5):
-            pass
-
-        if not fov_recompute:
-            key_char = chr(key.c)
-
-            if key_char == 'g':
-                #try to pick up an item
-                for object in objects:
-                    if object.x == player.x and object.y == player.y and object.item:
-                        object.item.pick_up()
-                        break
-
-            if key_char == 'i':
-                #show the inventory
-                chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
-                if chosen_item is not None:
-                    chosen_item.use()
-
-            if key_char == 'd':
-                chosen_item = inventory_menu('Press the key next to an item to drop it, or any other to cancel.\n')
-                if chosen_item is not None:
-                    chosen_item.drop()
-
-            if key_char == '<':
-                if stairs.x == player.x and stairs.y == player.y:
-                    next_level()
-
-            if key_char == 'c':
-                #show character information
-                level_up_xp = LEVEL_UP_BASE + player.level + LEVEL_UP_FACTOR
-                msgbox('Character Information\n' +
-                       '\nLevel: ' + str(player.level) +
-                       '\nExperience: ' + str(player.fighter.xp) +
-                       '\nExperience to level up: ' + str(level_up_xp) + 
-                       '\n\nMaximum HP: ' + str(player.fighter.max_hp) +
-                       '\nAttack: ' + str(player.fighter.power) +
-                       '\nDefense: ' + str(player.fighter.defense), CHARACTER_SCREEN_WIDTH)
-
-            return 'didnt-take-turn'
+        command = read_command()
+        if command is not None:
+            record_input('command', command)
+        return apply_command(command)
+
+#(held key, keypad key, dx, dy)
+MOVE_KEYS = [(libtcod.KEY_UP, libtcod.KEY_KP8, 0, -1),
+             (libtcod.KEY_DOWN, libtcod.KEY_KP2, 0, 1),
+             (libtcod.KEY_LEFT, libtcod.KEY_KP4, -1, 0),
+             (libtcod.KEY_RIGHT, libtcod.KEY_KP6, 1, 0),
+             (libtcod.KEY_HOME, libtcod.KEY_KP7, -1, -1),
+             (libtcod.KEY_PAGEUP, libtcod.KEY_KP9, 1, -1),
+             (libtcod.KEY_END, libtcod.KEY_KP1, -1, 1),
+             (libtcod.KEY_PAGEDOWN, libtcod.KEY_KP3, 1, 1)]
+
+def read_command():
+    #this frame's input as a command: a move, a key for the other actions, or None
+    for (held, keypad, dx, dy) in MOVE_KEYS:
+        if libtcod.console_is_key_pressed(held) or key.vk == keypad:
+            return ('move', dx, dy)
+    if libtcod.console_is_key_pressed(libtcod.KEY_KP5):
+        return None
+    if key.c:
+        return ('key', chr(key.c))
+    return None
+
+def apply_command(command):
+    #carry out a command, from the keyboard or an input log
+    if command is not None and command[0] == 'move':
+        player_move_or_attack(command[1], command[2])
+
+    if not fov_recompute:
+        key_char = command[1] if command is not None and command[0] == 'key' else ''
+
+        if key_char == 'g':
+            #try to pick up an item
+            for object in components['item'].entities:
+                if object.x == player.x and object.y == player.y:
+                    object.item.pick_up()
+                    break
+
+        if key_char == 'i':
+            #show the inventory
+            chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
+            if chosen_item is not None:
+                chosen_item.use()
+
+        if key_char == 'd':
+            chosen_item = inventory_menu('Press the key next to an item to drop it, or any other to cancel.\n')
+            if chosen_item is not None:
+                chosen_item.drop()
+
+        if key_char == '<':
+            if stairs.x == player.x and stairs.y == player.y:
+                next_level()
+
+        if key_char == 'c':
+            #show character information
+            level_up_xp = LEVEL_UP_BASE + player.level + LEVEL_UP_FACTOR
+            msgbox('Character Information\n' +
+                   '\nLevel: ' + str(player.level) +
+                   '\nExperience: ' + str(player.fighter.xp) +
+                   '\nExperience to level up: ' + str(level_up_xp) + 
+                   '\n\nMaximum HP: ' + str(player.fighter.max_hp) +
+                   '\nAttack: ' + str(player.fighter.power) +
+                   '\nDefense: ' + str(player.fighter.defense), CHARACTER_SCREEN_WIDTH)
+
+        return 'didnt-take-turn'
 
 def render_all():
     global color_dark_wall, color_light_wall
     global color_dark_ground, color_light_ground
-    global fov_map, fov_recompute
+    global fov_map, fov_recompute, map_buffer
 
     if fov_recompute:
         #recompute FOV if needed
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RANGE, FOV_LIGHT_WALLS, FOV_ALGO)
+        recompute_fov()
+    if map_buffer is None or map_buffer.width != MAP_WIDTH or map_buffer.height != MAP_HEIGHT:
+        map_buffer = libtcod.ConsoleBuffer(MAP_WIDTH, MAP_HEIGHT)
 
-    #go through all tiles and set their background color
+    #go through all tiles and pick their background color, then write them all
+    #to the buffer in one batch and send it to the console in one fill
+    (xs, ys, backs) = ([], [], [])
     for y in range(MAP_HEIGHT):
         for x in range(MAP_WIDTH):
-            visible = libtcod.map_is_in_fov(fov_map, x, y)
+            visible = is_in_fov(x, y)
             wall = map[x][y].block_sight
             if visible:
                 map[x][y].explored = True
-                if wall:
-                    libtcod.console_set_char_background(con_map, x, y, color_light_wall, libtcod.BKGND_SET)
-                else:
-                    libtcod.console_set_char_background(con_map, x, y, color_light_ground, libtcod.BKGND_SET)
+                backs.append(color_light_wall if wall else color_light_ground)
             elif map[x][y].explored:
-                if wall:
-                    libtcod.console_set_char_background(con_map, x, y, color_dark_wall, libtcod.BKGND_SET)
-                else:
-                    libtcod.console_set_char_background(con_map, x, y, color_dark_ground, libtcod.BKGND_SET)
+                backs.append(color_dark_wall if wall else color_dark_ground)
             else:
-                libtcod.console_set_char_background(con_map, x, y, libtcod.Color(0, 0, 0), libtcod.BKGND_SET)
+                backs.append(libtcod.black)
+            xs.append(x)
+            ys.append(y)
+    libtcod.console_put_chars(map_buffer, xs, ys, back=backs)
+    map_buffer.blit(con_map, fill_fore=False)
 
     for object in objects:
         if object != player:
@@ -940,7 +1864,19 @@ def render_all():
 
     #blit the contents of "con_map" to the root console
     libtcod.console_blit(con_map, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
-    
+
+    #only redraw the panel when something on it changed, but always show it
+    #since menus may have been drawn over it
+    names = get_names_under_mouse()
+    if status_dirty or names != status_names:
+        render_status(names)
+    libtcod.console_blit(con_status, 0, 0, PANEL_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+
+def render_status(names):
+    global status_dirty, status_names
+    status_dirty = False
+    status_names = names
+
     #show the player's stats
     libtcod.console_set_default_background(con_status, libtcod.black)
     libtcod.console_clear(con_status)
@@ -949,7 +1885,7 @@ def render_all():
                libtcod.light_red, libtcod.darker_red)
     libtcod.console_print_ex(con_status, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Dungeon level ' + str(dungeon_level))
     libtcod.console_set_default_foreground(con_status, libtcod.light_gray)
-    libtcod.console_print_ex(con_status, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+    libtcod.console_print_ex(con_status, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, names)
 
     #print the messages
     y = 1
@@ -958,19 +1894,29 @@ def render_all():
         libtcod.console_print_ex(con_status, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
         y += 1
 
-    libtcod.console_blit(con_status, 0, 0, PANEL_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+def new_game(seed=None):
+    global player, inventory, game_msgs, game_state, dungeon_level, game_tick, rng, stats, level_up_pending
+    global last_autosave, journal_base
+
+    #a seed makes the whole game reproducible, otherwise use libtcod's default generator
+    if seed is not None:
+        if rng != 0:
+            libtcod.random_delete(rng)
+        rng = libtcod.random_new_from_seed(seed)
+    stats = new_stats()
+    level_up_pending = False
 
-def new_game():
-    global player, inventory, game_msgs, game_state, dungeon_level
-    
     #create player object
     fighter_component = Fighter(hp=100, defense=1, power=2, xp=0, death_function=player_death)
     player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component, speed=PLAYER_SPEED)
     player.level = 1
 
     dungeon_level = 1
+    game_tick = 0
+    last_autosave = 0
+    journal_base = None
     make_map()
-    initialize_fov()
+    initialize_level()
     game_state = 'playing'
 
     game_msgs = []
@@ -984,10 +1930,33 @@ def new_game():
 
     message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', libtcod.red)
 
+def initialize_level():
+    #rebuild everything derived from the current level
+    global status_dirty
+    status_dirty = True
+    build_components()
+    initialize_fov()
+    initialize_paths()
+    initialize_timeline()
+    update_player_distance()
+
+def recompute_fov():
+    global fov_recompute, visible_cells, fov_plane
+    fov_recompute = False
+    fov_plane = None
+    if visibility is not None:
+        #precomputed level: FOV is just a lookup of the player's tile
+        visible_cells = bytearray(zlib.decompress(visibility[(player.x, player.y)]))
+    else:
+        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RANGE, FOV_LIGHT_WALLS, FOV_ALGO)
+
 def initialize_fov():
     libtcod.console_clear(con_map)
-    global fov_recompute, fov_map
+    global fov_recompute, fov_map, visible_cells, fov_plane, blocked_plane
     fov_recompute = True
+    visible_cells = None
+    fov_plane = None
+    blocked_plane = None
 
     fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
     for y in range(MAP_HEIGHT):
@@ -1016,36 +1985,588 @@ def play_game():
 
         player_action = handle_keys()
         if player_action == 'exit':
+            save_recording()
             main_menu()
             break
 
         if game_state == 'playing': # and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    if object.wait > 0:
-                        object.wait -= 1
-                    else:
-                        object.ai.take_turn()
+            run_timeline()
+            if AUTOSAVE_INTERVAL and game_tick - last_autosave >= AUTOSAVE_INTERVAL:
+                autosave()
+
+##############
+# Save Files #
+##############
+#a save is a header, the table of every string it uses, then the sections
+#written by encode_snapshot in order. tile planes are packed bits and entities
+#fixed records whose strings are indices into the table
+SAVE_MAGIC = b'EXRL'
+SAVE_VERSION = 1
+NO_ID = 0xffffffff
+
+HEADER_RECORD = struct.Struct('<4sHHH') #magic, version, map width, map height
+ENTITY_RECORD = struct.Struct('<IhhIIBBBBhhh') #id, x, y, char, name, r, g, b, flags, speed, wait, level
+FIGHTER_RECORD = struct.Struct('<iiiiiIh') #base max hp, hp, base defense, base power, xp, death function, attack speed
+ITEM_RECORD = struct.Struct('<I') #use function
+EQUIPMENT_RECORD = struct.Struct('<IhhhI') #slot, power, defense and max hp bonus, wearer id
+AI_RECORD = struct.Struct('<Ihh') #class name, then the target or the turns left confused
+
+#entity flags
+BLOCKS = 1
+ALWAYS_VISIBLE = 2
+HAS_FIGHTER = 4
+HAS_AI = 8
+HAS_ITEM = 16
+HAS_EQUIPMENT = 32
+HAS_LEVEL = 64
+
+class SaveWriter:
+    #collects the sections, interning strings as they are written
+    def __init__(self):
+        self.chunks = []
+        self.strings = {}
+
+    def pack(self, record, *values):
+        self.chunks.append(record.pack(*values))
+
+    def number(self, value):
+        self.chunks.append(struct.pack('<I', value))
+
+    def string(self, text):
+        #index of a string in the table, None is written as the empty string
+        if text is None:
+            text = ''
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+        return index
+
+    def blob(self, data):
+        self.number(len(data))
+        self.chunks.append(data)
+
+    def getvalue(self, width, height):
+        table = [struct.pack('<I', len(self.strings))]
+        for text in sorted(self.strings, key=self.strings.get):
+            data = text.encode('utf-8')
+            table.append(struct.pack('<I', len(data)))
+            table.append(data)
+        return b''.join([HEADER_RECORD.pack(SAVE_MAGIC, SAVE_VERSION, width, height)] + table + self.chunks)
+
+class SaveReader:
+    def __init__(self, data):
+        self.data = data
+        (magic, version, self.width, self.height) = HEADER_RECORD.unpack_from(data, 0)
+        if magic != SAVE_MAGIC or version > SAVE_VERSION:
+            raise ValueError('not a save this version can read')
+        self.offset = HEADER_RECORD.size
+        self.strings = []
+        for i in range(self.number()):
+            self.strings.append(self.blob().decode('utf-8'))
+
+    def unpack(self, record):
+        values = record.unpack_from(self.data, self.offset)
+        self.offset += record.size
+        return values
+
+    def number(self):
+        (value,) = struct.unpack_from('<I', self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def string(self, index):
+        return self.strings[index] or None
+
+    def blob(self, size=None):
+        if size is None:
+            size = self.number()
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return bytes(data)
+
+def pack_plane(values):
+    bits = bytearray((len(values) + 7) // 8)
+    for (i, value) in enumerate(values):
+        if value:
+            bits[i >> 3] |= 1 << (i & 7)
+    return bytes(bits)
+
+def unpack_plane(bits, size):
+    return [(bits[i >> 3] >> (i & 7)) & 1 == 1 for i in range(size)]
+
+def snapshot_ai(ai):
+    #AI layers as nested tuples, a confused monster wraps the AI it goes back to
+    if ai is None:
+        return None
+    if isinstance(ai, ConfusedMonster):
+        return ('ConfusedMonster', ai.num_turns, snapshot_ai(ai.old_ai))
+    return (ai.__class__.__name__, ai.target)
+
+def snapshot_entity(obj):
+    fighter = None
+    if obj.fighter:
+        f = obj.fighter
+        fighter = (f.base_max_hp, f.hp, f.base_defense, f.base_power, f.xp,
+                   f.death_function.__name__ if f.death_function else None, f.attack_speed)
+    item = None
+    if obj.item:
+        item = (obj.item.use_function.__name__ if obj.item.use_function else None,)
+    equipment = None
+    if obj.equipment:
+        e = obj.equipment
+        equipment = (e.slot, e.power_bonus, e.defense_bonus, e.max_hp_bonus,
+                     e.wearer.owner.id if e.wearer is not None else None)
+    return (obj.id, obj.x, obj.y, obj.char, obj.name, (obj.color.r, obj.color.g, obj.color.b),
+            obj.blocks, obj.always_visible, obj.speed, obj.wait, getattr(obj, 'level', None),
+            fighter, snapshot_ai(obj.ai), item, equipment)
+
+def snapshot_game():
+    #a copy of the game state made only of immutable values, cheap enough to
+    #take on the main thread and safe to encode anywhere else
+    cells = [map[x][y] for y in range(MAP_HEIGHT) for x in range(MAP_WIDTH)]
+    return {'width': MAP_WIDTH,
+            'height': MAP_HEIGHT,
+            'blocked': pack_plane([tile.blocked for tile in cells]),
+            'block_sight': pack_plane([tile.block_sight for tile in cells]),
+            'explored': pack_plane([tile.explored for tile in cells]),
+            'entities': tuple(snapshot_entity(obj) for obj in objects + inventory),
+            'objects': tuple(obj.id for obj in objects),
+            'inventory': tuple(obj.id for obj in inventory),
+            'player': player.id,
+            'stairs': stairs.id,
+            'messages': tuple((line, (color.r, color.g, color.b)) for (line, color) in game_msgs),
+            'game_state': game_state,
+            'dungeon_level': dungeon_level,
+            'game_tick': game_tick,
+            'rooms': tuple((room.x1, room.y1, room.x2, room.y2) for room in rooms),
+            'stats': json.dumps(stats),
+            'visibility': dict(visibility) if visibility is not None else None}
+
+def encode_ai(writer, ai):
+    if ai[0] == 'ConfusedMonster':
+        writer.pack(AI_RECORD, writer.string(ai[0]), ai[1], 0)
+        encode_ai(writer, ai[2])
+    else:
+        (x, y) = ai[1] if ai[1] is not None else (-1, -1)
+        writer.pack(AI_RECORD, writer.string(ai[0]), x, y)
+
+def encode_entity(writer, entity):
+    (id, x, y, char, name, (r, g, b), blocks, always_visible, speed, wait, level,
+     fighter, ai, item, equipment) = entity
+    flags = 0
+    for (present, flag) in ((blocks, BLOCKS), (always_visible, ALWAYS_VISIBLE), (fighter, HAS_FIGHTER),
+                            (ai, HAS_AI), (item, HAS_ITEM), (equipment, HAS_EQUIPMENT), (level is not None, HAS_LEVEL)):
+        if present:
+            flags |= flag
+    writer.pack(ENTITY_RECORD, id, x, y, writer.string(char), writer.string(name), r, g, b, flags,
+                speed, wait, level or 0)
+    if fighter:
+        writer.pack(FIGHTER_RECORD, *(fighter[:5] + (writer.string(fighter[5]), fighter[6])))
+    if ai:
+        encode_ai(writer, ai)
+    if item:
+        writer.pack(ITEM_RECORD, writer.string(item[0]))
+    if equipment:
+        (slot, power, defense, max_hp, wearer) = equipment
+        writer.pack(EQUIPMENT_RECORD, writer.string(slot), power, defense, max_hp,
+                    NO_ID if wearer is None else wearer)
+
+def encode_snapshot(snapshot):
+    writer = SaveWriter()
+    for plane in ('blocked', 'block_sight', 'explored'):
+        writer.chunks.append(snapshot[plane])
+
+    writer.number(len(snapshot['entities']))
+    for entity in snapshot['entities']:
+        encode_entity(writer, entity)
+    for ids in (snapshot['objects'], snapshot['inventory']):
+        writer.number(len(ids))
+        writer.chunks.append(struct.pack('<%dI' % len(ids), *ids))
+    writer.number(snapshot['player'])
+    writer.number(snapshot['stairs'])
+
+    writer.number(len(snapshot['messages']))
+    for (line, (r, g, b)) in snapshot['messages']:
+        writer.chunks.append(struct.pack('<IBBB', writer.string(line), r, g, b))
+    writer.number(writer.string(snapshot['game_state']))
+    writer.number(snapshot['dungeon_level'])
+    writer.number(snapshot['game_tick'])
+    writer.number(len(snapshot['rooms']))
+    for room in snapshot['rooms']:
+        writer.chunks.append(struct.pack('<hhhh', *room))
+    writer.number(writer.string(snapshot['stats']))
+
+    if snapshot['visibility'] is None:
+        writer.number(NO_ID)
+    else:
+        writer.number(len(snapshot['visibility']))
+        for ((x, y), bits) in sorted(snapshot['visibility'].items()):
+            writer.chunks.append(struct.pack('<hh', x, y))
+            writer.blob(bits)
+    return writer.getvalue(snapshot['width'], snapshot['height'])
+
+def decode_ai(reader):
+    (name, a, b) = reader.unpack(AI_RECORD)
+    name = reader.string(name)
+    if name == 'ConfusedMonster':
+        return (name, a, decode_ai(reader))
+    return (name, (a, b) if a >= 0 else None)
+
+def decode_entity(reader):
+    (id, x, y, char, name, r, g, b, flags, speed, wait, level) = reader.unpack(ENTITY_RECORD)
+    fighter = ai = item = equipment = None
+    if flags & HAS_FIGHTER:
+        values = reader.unpack(FIGHTER_RECORD)
+        fighter = values[:5] + (reader.string(values[5]), values[6])
+    if flags & HAS_AI:
+        ai = decode_ai(reader)
+    if flags & HAS_ITEM:
+        item = (reader.string(reader.unpack(ITEM_RECORD)[0]),)
+    if flags & HAS_EQUIPMENT:
+        (slot, power, defense, max_hp, wearer) = reader.unpack(EQUIPMENT_RECORD)
+        equipment = (reader.string(slot), power, defense, max_hp, None if wearer == NO_ID else wearer)
+    return (id, x, y, reader.string(char), reader.string(name), (r, g, b),
+            bool(flags & BLOCKS), bool(flags & ALWAYS_VISIBLE), speed, wait,
+            level if flags & HAS_LEVEL else None, fighter, ai, item, equipment)
+
+def decode_snapshot(data):
+    reader = SaveReader(data)
+    snapshot = {'width': reader.width, 'height': reader.height}
+    plane_size = (reader.width * reader.height + 7) // 8
+    for plane in ('blocked', 'block_sight', 'explored'):
+        snapshot[plane] = reader.blob(plane_size)
+
+    snapshot['entities'] = tuple(decode_entity(reader) for i in range(reader.number()))
+    for key in ('objects', 'inventory'):
+        count = reader.number()
+        snapshot[key] = struct.unpack_from('<%dI' % count, reader.data, reader.offset)
+        reader.offset += 4 * count
+    snapshot['player'] = reader.number()
+    snapshot['stairs'] = reader.number()
+
+    messages = []
+    for i in range(reader.number()):
+        (line, r, g, b) = struct.unpack_from('<IBBB', reader.data, reader.offset)
+        reader.offset += 7
+        messages.append((reader.string(line), (r, g, b)))
+    snapshot['messages'] = tuple(messages)
+    snapshot['game_state'] = reader.string(reader.number())
+    snapshot['dungeon_level'] = reader.number()
+    snapshot['game_tick'] = reader.number()
+    rooms = []
+    for i in range(reader.number()):
+        rooms.append(struct.unpack_from('<hhhh', reader.data, reader.offset))
+        reader.offset += 8
+    snapshot['rooms'] = tuple(rooms)
+    snapshot['stats'] = reader.string(reader.number())
+
+    count = reader.number()
+    if count == NO_ID:
+        snapshot['visibility'] = None
+    else:
+        snapshot['visibility'] = {}
+        for i in range(count):
+            (x, y) = struct.unpack_from('<hh', reader.data, reader.offset)
+            reader.offset += 4
+            snapshot['visibility'][(x, y)] = reader.blob()
+    return snapshot
+
+def restore_ai(ai, owner):
+    if ai is None:
+        return None
+    if ai[0] == 'ConfusedMonster':
+        component = ConfusedMonster(restore_ai(ai[2], owner), ai[1])
+    else:
+        component = globals()[ai[0]]()
+        component.target = ai[1]
+    component.owner = owner
+    return component
+
+def restore_entity(entity):
+    (id, x, y, char, name, color, blocks, always_visible, speed, wait, level,
+     fighter, ai, item, equipment) = entity
+    obj = Object(x, y, char, name, libtcod.color_get(*color), blocks=blocks, always_visible=always_visible, speed=speed)
+    obj.wait = wait
+    if level is not None:
+        obj.level = level
+    if fighter:
+        (max_hp, hp, defense, power, xp, death, attack_speed) = fighter
+        obj.fighter = Fighter(max_hp, defense, power, xp, globals()[death] if death else None, attack_speed)
+        obj.fighter.owner = obj
+        obj.fighter.hp = hp
+    obj.ai = restore_ai(ai, obj)
+    if item:
+        obj.item = Item(globals()[item[0]] if item[0] else None)
+        obj.item.owner = obj
+    if equipment:
+        obj.equipment = Equipment(*equipment[:4])
+        obj.equipment.owner = obj
+    return obj
+
+def restore_snapshot(snapshot):
+    #rebuild the game from a snapshot, the inverse of snapshot_game
+    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level, visibility
+    global game_tick, rooms, stats, level_up_pending, MAP_WIDTH, MAP_HEIGHT
+
+    MAP_WIDTH = snapshot['width']
+    MAP_HEIGHT = snapshot['height']
+    size = MAP_WIDTH * MAP_HEIGHT
+    blocked = unpack_plane(snapshot['blocked'], size)
+    block_sight = unpack_plane(snapshot['block_sight'], size)
+    explored = unpack_plane(snapshot['explored'], size)
+    map = [[Tile(blocked[x + y * MAP_WIDTH], block_sight[x + y * MAP_WIDTH])
+        for y in range(MAP_HEIGHT)]
+            for x in range(MAP_WIDTH)]
+    for x in range(MAP_WIDTH):
+        for y in range(MAP_HEIGHT):
+            map[x][y].explored = explored[x + y * MAP_WIDTH]
+
+    #the saved ids only tie the records together, restored objects get new ones
+    by_id = dict((entity[0], restore_entity(entity)) for entity in snapshot['entities'])
+    for entity in snapshot['entities']:
+        equipment = entity[14]
+        if equipment and equipment[4] is not None:
+            by_id[equipment[4]].fighter.wear(by_id[entity[0]].equipment)
+    objects = [by_id[id] for id in snapshot['objects']]
+    inventory = [by_id[id] for id in snapshot['inventory']]
+    player = by_id[snapshot['player']]
+    stairs = by_id[snapshot['stairs']]
+
+    game_msgs = [(line, libtcod.color_get(*color)) for (line, color) in snapshot['messages']]
+    game_state = snapshot['game_state']
+    dungeon_level = snapshot['dungeon_level']
+    game_tick = snapshot['game_tick']
+    rooms = [Rect(x1, y1, x2 - x1, y2 - y1) for (x1, y1, x2, y2) in snapshot['rooms']]
+    stats = json.loads(snapshot['stats'])
+    visibility = snapshot['visibility']
+    level_up_pending = True
+    initialize_level()
+
+def write_snapshot(snapshot, path=SAVE_FILE):
+    #write to a temporary file and rename it over the save, so a crash midway
+    #leaves the previous save intact. the journal held changes to the old save,
+    #so it goes too
+    data = encode_snapshot(snapshot)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    if os.path.exists(journal_path(path)):
+        os.remove(journal_path(path))
+
+def write_save(path=SAVE_FILE):
+    global journal_base, journal_entries
+    finish_autosave()
+    snapshot = snapshot_game()
+    write_snapshot(snapshot, path)
+    (journal_base, journal_entries) = (snapshot, 0)
+
+def read_save(path=SAVE_FILE):
+    with open(path, 'rb') as file:
+        snapshot = decode_snapshot(file.read())
+    restore_snapshot(replay_journal(snapshot, path))
+
+###########
+# Journal #
+###########
+#between full saves, autosaves append a delta against the previous save: the
+#tile planes XORed with their old bits and compressed, created and deleted
+#entities, the changed fields of the others and any other value that changed.
+#each entry is a length and a save-format payload holding one value in the
+#tagged format below
+journal_base = None #the snapshot the next delta is taken against, None for a full save
+journal_entries = 0
+PLANES = ('blocked', 'block_sight', 'explored')
+
+def journal_path(path=SAVE_FILE):
+    return os.path.splitext(path)[0] + '.journal'
+
+def encode_value(writer, value):
+    #None, booleans, integers, strings, bytes, and tuples, lists and dicts of them
+    if value is None or value is True or value is False:
+        writer.chunks.append({None: b'N', True: b'T', False: b'F'}[value])
+    elif isinstance(value, int):
+        if -0x80 <= value < 0x80:
+            writer.chunks.append(b'c' + struct.pack('<b', value))
+        elif -0x80000000 <= value < 0x80000000:
+            writer.chunks.append(b'i' + struct.pack('<i', value))
+        else:
+            writer.chunks.append(b'q' + struct.pack('<q', value))
+    elif isinstance(value, str):
+        writer.chunks.append(b's' + struct.pack('<I', writer.string(value)))
+    elif isinstance(value, bytes):
+        writer.chunks.append(b'b')
+        writer.blob(value)
+    elif isinstance(value, dict):
+        writer.chunks.append(b'd')
+        writer.number(len(value))
+        for (key, item) in value.items():
+            encode_value(writer, key)
+            encode_value(writer, item)
+    else:
+        writer.chunks.append(b't')
+        writer.number(len(value))
+        for item in value:
+            encode_value(writer, item)
+
+def decode_value(reader):
+    tag = reader.blob(1)
+    if tag in (b'N', b'T', b'F'):
+        return {b'N': None, b'T': True, b'F': False}[tag]
+    if tag in (b'c', b'i', b'q'):
+        record = {b'c': '<b', b'i': '<i', b'q': '<q'}[tag]
+        (value,) = struct.unpack_from(record, reader.data, reader.offset)
+        reader.offset += struct.calcsize(record)
+        return value
+    if tag == b's':
+        return reader.strings[reader.number()]
+    if tag == b'b':
+        return reader.blob()
+    if tag == b'd':
+        return dict((decode_value(reader), decode_value(reader)) for i in range(reader.number()))
+    return tuple(decode_value(reader) for i in range(reader.number()))
+
+def diff_snapshots(base, snapshot):
+    planes = {}
+    for plane in PLANES:
+        if base[plane] != snapshot[plane]:
+            planes[plane] = zlib.compress(bytes(old ^ new for (old, new) in zip(base[plane], snapshot[plane])))
+
+    old_entities = dict((entity[0], entity) for entity in base['entities'])
+    created = []
+    changed = []
+    for entity in snapshot['entities']:
+        old = old_entities.pop(entity[0], None)
+        if old is None:
+            created.append(entity)
+        elif old != entity:
+            changed.append((entity[0], tuple((field, new) for (field, (value, new)) in enumerate(zip(old, entity))
+                                             if value != new)))
+
+    values = dict((key, value) for (key, value) in snapshot.items()
+                  if key not in PLANES and key != 'entities' and base[key] != value)
+    return {'base tick': base['game_tick'], 'planes': planes, 'created': tuple(created),
+            'deleted': tuple(old_entities), 'changed': tuple(changed), 'values': values}
+
+def apply_delta(snapshot, delta):
+    snapshot = dict(snapshot)
+    for (plane, changes) in delta['planes'].items():
+        snapshot[plane] = bytes(old ^ change for (old, change) in zip(snapshot[plane], zlib.decompress(changes)))
+
+    deleted = set(delta['deleted'])
+    changes = dict(delta['changed'])
+    entities = []
+    for entity in snapshot['entities']:
+        if entity[0] in deleted:
+            continue
+        if entity[0] in changes:
+            entity = list(entity)
+            for (field, value) in changes[entity[0]]:
+                entity[field] = value
+            entity = tuple(entity)
+        entities.append(entity)
+    snapshot['entities'] = tuple(entities) + delta['created']
+    snapshot.update(delta['values'])
+    return snapshot
+
+def append_journal(base, snapshot, path=SAVE_FILE):
+    #runs on the autosave thread, so the diff is not paid for on the main one
+    writer = SaveWriter()
+    encode_value(writer, diff_snapshots(base, snapshot))
+    data = writer.getvalue(snapshot['width'], snapshot['height'])
+    with open(journal_path(path), 'ab') as file:
+        file.write(struct.pack('<I', len(data)) + data)
+        file.flush()
+        os.fsync(file.fileno())
+
+def replay_journal(snapshot, path=SAVE_FILE):
+    #apply the journal to the full save it belongs to. a torn last entry from a
+    #crash, or entries that do not follow on from the save, are ignored
+    if not os.path.exists(journal_path(path)):
+        return snapshot
+    with open(journal_path(path), 'rb') as file:
+        data = file.read()
+    offset = 0
+    while offset + 4 <= len(data):
+        (size,) = struct.unpack_from('<I', data, offset)
+        if offset + 4 + size > len(data):
+            break
+        delta = decode_value(SaveReader(data[offset + 4:offset + 4 + size]))
+        if delta['base tick'] != snapshot['game_tick']:
+            break
+        snapshot = apply_delta(snapshot, delta)
+        offset += 4 + size
+    return snapshot
 
 def save_game():
-    #open a new empty shelfe to write the game
     if game_state == 'exit':
-        file = shelve.open('savegame', 'n')
-        file['map'] = map
-        file['objects'] = objects
-        file['player_index'] = objects.index(player)
-        file['stairs_index'] = objects.index(stairs)
-        file['inventory'] = inventory
-        file['game_msgs'] = game_msgs
-        file['game_state'] = game_state
-        file['dungeon_level'] = dungeon_level
-        file.close()
+        write_save()
+
+autosave_thread = None #the background write in progress, if any
+last_autosave = 0 #game tick of the last autosave
+
+def autosave():
+    #snapshot on the main thread, then encode and write in the background. if
+    #the last autosave is still writing, skip this one rather than wait for it
+    global autosave_thread, last_autosave, journal_base, journal_entries
+    if autosave_thread is not None and autosave_thread.is_alive():
+        return
+    last_autosave = game_tick
+    snapshot = snapshot_game()
+    base = journal_base
+    if (SAVE_JOURNAL and base is not None and journal_entries < JOURNAL_LIMIT and
+            (base['width'], base['height'], base['dungeon_level']) ==
+            (snapshot['width'], snapshot['height'], snapshot['dungeon_level'])):
+        autosave_thread = threading.Thread(target=append_journal, args=(base, snapshot))
+        journal_entries += 1
+    else:
+        #nothing to diff against, a new level or a long journal: compact into a full save
+        autosave_thread = threading.Thread(target=write_snapshot, args=(snapshot,))
+        journal_entries = 0
+    journal_base = snapshot
+    autosave_thread.daemon = True
+    autosave_thread.start()
+
+def finish_autosave():
+    #wait for a background write, before anything else touches the save file
+    if autosave_thread is not None:
+        autosave_thread.join()
 
 def load_game():
+    global last_autosave, journal_base
+    finish_autosave()
+    if os.path.exists(SAVE_FILE):
+        read_save()
+    else:
+        load_shelve() #a game saved before the binary format
+    last_autosave = game_tick
+    journal_base = None #the loaded objects have new ids, so the next autosave is a full one
+
+def save_shelve(path='savegame'):
+    #open a new empty shelfe to write the game
+    file = shelve.open(path, 'n')
+    file['map'] = map
+    file['objects'] = objects
+    file['player_index'] = objects.index(player)
+    file['stairs_index'] = objects.index(stairs)
+    file['inventory'] = inventory
+    file['game_msgs'] = game_msgs
+    file['game_state'] = game_state
+    file['dungeon_level'] = dungeon_level
+    file['visibility'] = visibility
+    file['game_tick'] = game_tick
+    file['rooms'] = rooms
+    file['stats'] = stats
+    file.close()
+
+def load_shelve(path='savegame'):
     #open the previously saved shelve
-    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
+    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level, visibility
+    global game_tick, rooms, stats, level_up_pending
 
-    file = shelve.open('savegame', 'r')
+    file = shelve.open(path, 'r')
     map = file['map']
     objects = file['objects']
     player = objects[file['player_index']]
@@ -1054,16 +2575,481 @@ def load_game():
     game_msgs = file['game_msgs']
     game_state = file['game_state']
     dungeon_level = file['dungeon_level']
+    #saves from before visibility precomputation have no sets, fall back to live FOV
+    visibility = file['visibility'] if 'visibility' in file else None
+    game_tick = file['game_tick'] if 'game_tick' in file else 0
+    rooms = file['rooms'] if 'rooms' in file else []
+    stats = file['stats'] if 'stats' in file else new_stats()
+    level_up_pending = True
     file.close()
-    initialize_fov()
+    #every key is pickled on its own, so the player's worn items come back as
+    #copies of the inventory ones (and older saves only flag them). wear the
+    #inventory ones again
+    fighter = player.fighter
+    fighter.equipped = {}
+    fighter.power_bonus = fighter.defense_bonus = fighter.max_hp_bonus = 0
+    for obj in inventory:
+        if obj.equipment and obj.equipment.is_equipped:
+            fighter.wear(obj.equipment)
+    initialize_level()
+
+def benchmark_save():
+    #time saving and loading a played game, and the size on disk, with the shelve
+    #files against the binary format and a journal entry on top of it
+    simulate(1, 5000)
+    folder = 'benchmark_saves'
+    if not os.path.isdir(folder):
+        os.mkdir(folder)
+    shelve_path = os.path.join(folder, 'savegame')
+    binary_path = os.path.join(folder, 'binary.sav')
+
+    print('%-8s %10s %10s %10s' % ('format', 'save', 'load', 'bytes'))
+    for (label, save, load, path) in (('shelve', save_shelve, load_shelve, shelve_path),
+                                      ('binary', write_save, read_save, binary_path)):
+        start = time.time()
+        for i in range(20):
+            save(path)
+        saving = (time.time() - start) / 20
+        start = time.time()
+        for i in range(20):
+            load(path)
+        loading = (time.time() - start) / 20
+        size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+                   if name.startswith(os.path.basename(path)))
+        print('%-8s %9.4fs %9.4fs %10d' % (label, saving, loading, size))
+
+    #what the next few hundred ticks of play add to the journal
+    write_save(binary_path)
+    base = snapshot_game()
+    run_headless(game_tick + 300)
+    start = time.time()
+    append_journal(base, snapshot_game(), binary_path)
+    saving = time.time() - start
+    start = time.time()
+    read_save(binary_path)
+    loading = time.time() - start
+    print('%-8s %9.4fs %9.4fs %10d' % ('journal', saving, loading, os.path.getsize(journal_path(binary_path))))
+    shutil.rmtree(folder)
+
+####################
+# Entity Benchmark #
+####################
+def plain_class(cls):
+    #the same class without __slots__, as the game classes used to be
+    namespace = dict((name, value) for (name, value) in cls.__dict__.items()
+                     if name != '__slots__' and name not in cls.__slots__)
+    return type(cls.__name__, (), namespace)
+
+def benchmark_entities():
+    #memory and attribute access of a level full of monsters, with the slotted
+    #classes versus plain ones
+    plain = (plain_class(Object), plain_class(Fighter), plain_class(BasicMonster), plain_class(Tile))
+    slotted = (Object, Fighter, BasicMonster, Tile)
+
+    print('%-10s %-8s %12s %10s' % ('monsters', 'classes', 'bytes', 'access'))
+    for count in (1000, 10000, 100000):
+        for (label, (object_class, fighter_class, ai_class, tile_class)) in (('plain', plain), ('slotted', slotted)):
+            tracemalloc.start()
+            tiles = [[tile_class(False) for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH)]
+            monsters = [object_class(i % MAP_WIDTH, i % MAP_HEIGHT, 'o', 'Orc', libtcod.desaturated_green, blocks=True,
+                                     fighter=fighter_class(hp=10, defense=0, power=3, xp=35), ai=ai_class())
+                        for i in range(count)]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            #the kind of reads the AI and render loops do for every monster
+            start = time.time()
+            for monster in monsters:
+                if tiles[monster.x][monster.y].blocked or monster.fighter.hp <= 0 or monster.ai.target is not None:
+                    monster.wait = monster.speed
+            elapsed = time.time() - start
+            print('%-10d %-8s %12d %9.4fs' % (count, label, size, elapsed))
+
+#####################
+# Binding Benchmark #
+#####################
+def benchmark_bindings():
+    #calls per second of the libtcod calls made for every cell, through the
+    #wrappers as they are and as they were: the old bodies, calling a second
+    #handle on the library so no signature declared on the first one applies
+    untyped = CDLL(libtcod._lib._name)
+    untyped.TCOD_map_is_in_fov.restype = c_bool
+    con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+    color = libtcod.Color(50, 50, 150)
+
+    def untyped_put_char(x, y):
+        c = '#'
+        if type(c) == str or type(c) == bytes:
+            untyped.TCOD_console_put_char(con, x, y, ord(c), libtcod.BKGND_NONE)
+        else:
+            untyped.TCOD_console_put_char(con, x, y, c, libtcod.BKGND_NONE)
+
+    calls = [('console_put_char', untyped_put_char,
+              lambda x, y: libtcod.console_put_char(con, x, y, '#', libtcod.BKGND_NONE)),
+             ('console_set_char_background',
+              lambda x, y: untyped.TCOD_console_set_char_background(con, x, y, color, libtcod.BKGND_SET),
+              lambda x, y: libtcod.console_set_char_background(con, x, y, color, libtcod.BKGND_SET)),
+             ('map_set_properties',
+              lambda x, y: untyped.TCOD_map_set_properties(fov_map, x, y, c_int(True), c_int(False)),
+              lambda x, y: libtcod.map_set_properties(fov_map, x, y, True, False)),
+             ('map_is_in_fov',
+              lambda x, y: untyped.TCOD_map_is_in_fov(fov_map, x, y),
+              lambda x, y: libtcod.map_is_in_fov(fov_map, x, y)),
+             ('random_get_int',
+              lambda x, y: untyped.TCOD_random_get_int(0, x, y),
+              lambda x, y: libtcod.random_get_int(0, x, y))]
+
+    rounds = 20
+    print('%-28s %14s %14s %8s' % ('call', 'before/s', 'after/s', 'speedup'))
+    for (name, before, after) in calls:
+        rates = []
+        for call in (before, after):
+            start = time.time()
+            for i in range(rounds):
+                for y in range(MAP_HEIGHT):
+                    for x in range(MAP_WIDTH):
+                        call(x, y)
+            rates.append(rounds * MAP_WIDTH * MAP_HEIGHT / (time.time() - start))
+        print('%-28s %14d %14d %7.2fx' % (name, rates[0], rates[1], rates[1] / rates[0]))
+
+    libtcod.map_delete(fov_map)
+    libtcod.console_delete(con)
+
+###################
+# Noise Benchmark #
+###################
+def benchmark_noise():
+    #seconds to fill an fBm noise field point by point and with one grid call,
+    #for a level and an overworld sized grid
+    noise = libtcod.noise_new(2)
+    (scale, octaves) = (0.05, 4.0)
+    print('%-10s %12s %12s' % ('size', 'per point', 'grid'))
+    for (width, height) in ((MAP_WIDTH, MAP_HEIGHT), (1000, 1000)):
+        start = time.time()
+        for y in range(height):
+            for x in range(width):
+                libtcod.noise_get_fbm(noise, [x * scale, y * scale], octaves)
+        times = [time.time() - start]
+
+        start = time.time()
+        libtcod.noise_get_fbm_grid(noise, width, height, scale=(scale, scale), octaves=octaves)
+        times.append(time.time() - start)
+        print('%-10s' % ('%dx%d' % (width, height)) + ''.join(' %11.3fs' % t for t in times))
+    libtcod.noise_delete(noise)
+
+#######################
+# Headless Simulation #
+#######################
+rng = 0 #the random generator for the game, 0 is libtcod's default one
+bot = None #when set, the bot plays instead of the keyboard and answers menus
+#(name, event, condition on the event's arguments)
+ACHIEVEMENTS = [('First blood', ON_DEATH, lambda obj, source: obj != player),
+                ('Troll slayer', ON_DEATH, lambda obj, source: obj.name == 'Troll'),
+                ('Into the depths', ON_LEVEL_CHANGE, lambda level: level >= 5)]
+
+def new_stats():
+    return {'kills': {}, 'items used': {}, 'killed by': None, 'achievements': []}
+
+stats = new_stats()
+
+def record_death(obj, source):
+    if obj == player:
+        if stats['killed by'] is None:
+            stats['killed by'] = source.name if source is not None else 'unknown'
+    else:
+        stats['kills'][obj.name] = stats['kills'].get(obj.name, 0) + 1
+
+def record_item_use(obj):
+    stats['items used'][obj.name] = stats['items used'].get(obj.name, 0) + 1
+
+def watch_achievement(name, event, condition):
+    def check(*args):
+        if name not in stats['achievements'] and condition(*args):
+            stats['achievements'].append(name)
+            message('Achievement unlocked: ' + name + '!', libtcod.gold)
+    subscribe(event, check)
+
+subscribe(ON_DEATH, record_death)
+subscribe(ON_ITEM_USE, record_item_use)
+for (name, event, condition) in ACHIEVEMENTS:
+    watch_achievement(name, event, condition)
+
+class BotPlayer:
+    #a scripted player for headless runs: fights what it sees, uses its items,
+    #explores every floor tile it can reach and then takes the stairs
+    def __init__(self):
+        self.turns = 0
+
+    def choose(self, header, options):
+        #cycle through the stats on level up, back out of anything else
+        if not options:
+            return None
+        return (player.level - 1) % len(options)
+
+    def choose_target(self, max_range):
+        #aim at the closest visible monster, if it is far enough not to get burned too
+        monster = closest_monster(max_range or FIREBALL_RANGE)
+        if monster is None or player.distance_to(monster) <= FIREBALL_RADIUS:
+            return (None, None)
+        return (monster.x, monster.y)
+
+    def use(self, name):
+        #use the first item with this name, true if it was used up
+        for obj in inventory:
+            if obj.name == name:
+                obj.item.use()
+                return obj not in inventory
+        return False
+
+    def take_turn(self):
+        self.turns += 1
+        fighter = player.fighter
+        visible = [obj for obj in components['fighter'].entities
+                   if obj is not player and is_in_fov(obj.x, obj.y)]
+
+        if fighter.hp < fighter.max_hp / 3 and self.use('healing potion'):
+            return
+
+        if visible:
+            nearest = min(visible, key=player.distance_to)
+            if player.distance_to(nearest) < 2:
+                player_move_or_attack(nearest.x - player.x, nearest.y - player.y)
+                return
+            for name in ('scroll of lightning bolt', 'scroll of fireball', 'scroll of confusion'):
+                if self.use(name):
+                    return
+            self.walk_towards([(nearest.x, nearest.y, 0)])
+            return
+
+        if len(inventory) < 26:
+            for obj in components['item'].entities:
+                if obj.x == player.x and obj.y == player.y:
+                    obj.item.pick_up()
+                    return
+
+        #head for visible items and unexplored floor, then for the stairs
+        goals = [(obj.x, obj.y, 0) for obj in components['item'].entities if is_in_fov(obj.x, obj.y)]
+        goals += [(x, y, 0) for x in range(MAP_WIDTH) for y in range(MAP_HEIGHT)
+                  if not map[x][y].blocked and not map[x][y].explored]
+        if self.walk_towards(goals):
+            return
+        if stairs.x == player.x and stairs.y == player.y:
+            next_level()
+        else:
+            self.walk_towards([(stairs.x, stairs.y, 0)])
+
+    def walk_towards(self, goals):
+        #one step downhill on a field to the goals, false if none is reachable
+        if not goals:
+            return False
+        field = distance_field(goals)
+        best = field[player.x + player.y * MAP_WIDTH]
+        if best == UNREACHABLE:
+            return False
+
+        step = None
+        for (dx, dy) in NEIGHBOURS:
+            x = player.x + dx
+            y = player.y + dy
+            if field[x + y * MAP_WIDTH] < best and not map[x][y].blocked:
+                best = field[x + y * MAP_WIDTH]
+                step = (dx, dy)
+        if step is None:
+            player.wait = player.speed #standing on the goal, or hemmed in
+        else:
+            player_move_or_attack(*step) #attacks whatever blocks the way
+        return True
+
+def explore_visible():
+    #what render_all does to the explored flags, for runs that never render
+    radius = TORCH_RANGE or max(MAP_WIDTH, MAP_HEIGHT)
+    for y in range(max(0, player.y - radius), min(MAP_HEIGHT, player.y + radius + 1)):
+        for x in range(max(0, player.x - radius), min(MAP_WIDTH, player.x + radius + 1)):
+            if is_in_fov(x, y):
+                map[x][y].explored = True
+
+def run_headless(max_ticks):
+    #the play_game loop without a window, with the bot standing in for handle_keys
+    while game_state == 'playing' and game_tick < max_ticks:
+        if fov_recompute:
+            recompute_fov()
+            explore_visible()
+        if level_up_pending:
+            check_level_up()
+
+        if player.wait > 0:
+            player.wait -= 1
+        else:
+            bot.take_turn()
+
+        if game_state == 'playing':
+            run_timeline()
+
+def simulate(seed, max_ticks=SIMULATION_MAX_TICKS):
+    #play one whole game with the bot and return its metrics as one result row
+    global bot, con_map, PRECOMPUTE_VISIBILITY
+    PRECOMPUTE_VISIBILITY = False #pool workers cannot start pools of their own
+    if con_map is None:
+        con_map = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+
+    bot = BotPlayer()
+    new_game(seed)
+    run_headless(max_ticks)
+    return {'seed': seed,
+            'batch ai': batch_ai_active(),
+            'depth': dungeon_level,
+            'turns': bot.turns,
+            'ticks': game_tick,
+            'died': game_state == 'dead',
+            'killed by': stats['killed by'],
+            'level': player.level,
+            'kills': stats['kills'],
+            'items used': stats['items used'],
+            'achievements': stats['achievements']}
+
+def run_simulations(runs, first_seed=1, path=SIMULATION_RESULTS):
+    #play many seeded games across a process pool, one game per task, and
+    #write the metrics out column by column
+    start = time.time()
+    columns = {}
+    pool = multiprocessing.Pool()
+    try:
+        for row in pool.imap_unordered(simulate, range(first_seed, first_seed + runs)):
+            for (name, value) in row.items():
+                columns.setdefault(name, []).append(value)
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(path, 'w') as file:
+        json.dump(columns, file)
+    print('%d games in %.1fs, results in %s' % (runs, time.time() - start, path))
+
+################
+# Input Replay #
+################
+#a new game records its seed and every input it acts on, each with the tick it
+#came in: commands from handle_keys, menu choices and targeted tiles. replaying
+#feeds them back through the bot's hooks, so the game runs headless at full speed
+recording = None #the log of the game being played, if it can be replayed
+
+def start_recording(seed):
+    global recording
+    recording = {'seed': seed, 'batch ai': batch_ai_active(), 'ticks': 0, 'events': []}
+
+def stop_recording():
+    global recording
+    recording = None
+
+def record_input(kind, value):
+    if recording is not None:
+        recording['events'].append((game_tick, kind, value))
+
+def save_recording(path=INPUT_LOG):
+    if recording is not None:
+        recording['ticks'] = game_tick
+        with open(path, 'w') as file:
+            json.dump(recording, file)
+
+class InputReplay:
+    #stands in for the bot, answering from an input log instead of deciding
+    def __init__(self, log):
+        self.events = log['events']
+        self.position = 0
+        self.turns = 0
+
+    def due(self, kind):
+        return (self.position < len(self.events) and
+                self.events[self.position][0] == game_tick and self.events[self.position][1] == kind)
+
+    def next(self, kind):
+        if not self.due(kind):
+            raise ValueError('the game went out of step with the input log at tick %d' % game_tick)
+        self.position += 1
+        return self.events[self.position - 1][2]
+
+    def take_turn(self):
+        self.turns += 1
+        apply_command(self.next('command') if self.due('command') else None)
+
+    def choose(self, header, options):
+        return self.next('menu')
+
+    def choose_target(self, max_range):
+        return tuple(self.next('target'))
+
+def replay_game(path=INPUT_LOG, render_every=0, final_frame=False):
+    #re-run a recorded game. with a window open, draw every Nth tick and/or
+    #the last one, otherwise nothing is drawn at all
+    global bot, con_map, mouse, key, BATCH_AI
+    with open(path) as file:
+        log = json.load(file)
+    if log.get('batch ai') and not numpy_available:
+        raise ValueError('the game was recorded with the batch AI, which needs NumPy')
+    BATCH_AI = log.get('batch ai', False) #the monsters must move as they did when it was recorded
+    if con_map is None:
+        con_map = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    (mouse, key) = (libtcod.Mouse(), libtcod.Key())
+
+    start = time.time()
+    bot = InputReplay(log)
+    new_game(log['seed'])
+    while game_state == 'playing' and game_tick < log['ticks']:
+        run_headless(min(log['ticks'], game_tick + render_every) if render_every else log['ticks'])
+        if render_every:
+            render_all()
+            libtcod.console_flush()
+    print('replayed %d ticks in %.2fs, the game is %s' % (game_tick, time.time() - start, game_state))
+
+    if final_frame:
+        render_all()
+        libtcod.console_flush()
+        libtcod.console_wait_for_keypress(True)
 
 ################################
 # Initialization and Main Loop #
 ################################
-libtcod.console_set_custom_font(b'arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, b'python/libtcod tutorial', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con_map = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-
-game_state = 'opening'
-main_menu()
+def open_window():
+    global con_map
+    libtcod.console_set_custom_font(b'arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, b'python/libtcod tutorial', False)
+    libtcod.sys_set_fps(LIMIT_FPS)
+    con_map = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+
+#worker processes re-import this module, so only the main process opens the window
+if __name__ == '__main__':
+    if '--benchmark-visibility' in sys.argv:
+        benchmark_visibility()
+        sys.exit()
+    if '--benchmark-ai' in sys.argv:
+        benchmark_ai()
+        sys.exit()
+    if '--benchmark-entities' in sys.argv:
+        benchmark_entities()
+        sys.exit()
+    if '--benchmark-save' in sys.argv:
+        benchmark_save()
+        sys.exit()
+    if '--benchmark-bindings' in sys.argv:
+        benchmark_bindings()
+        sys.exit()
+    if '--benchmark-noise' in sys.argv:
+        benchmark_noise()
+        sys.exit()
+    if '--simulate' in sys.argv:
+        run_simulations(int(sys.argv[sys.argv.index('--simulate') + 1]))
+        sys.exit()
+    if '--replay' in sys.argv:
+        #--replay LOG [--every N] [--final]
+        every = int(sys.argv[sys.argv.index('--every') + 1]) if '--every' in sys.argv else 0
+        final = '--final' in sys.argv
+        if every or final:
+            open_window()
+        replay_game(sys.argv[sys.argv.index('--replay') + 1], every, final)
+        sys.exit()
+
+    open_window()
+
+    game_state = 'opening'
+    main_menu()
@@ -28,6 +28,7 @@
 import sys
 import ctypes
 import struct
+import array
 from ctypes import *
 
 if not hasattr(ctypes, "c_bool"):   # for Python < 2.6
@@ -83,25 +84,44 @@ TECHVERSION = 0x01050103
 # color module
 ############################
 class Color(Structure):
+    # colors are immutable and hashable, so one instance can be shared by every
+    # cell that uses it. color_get returns the interned one for an rgb value, and
+    # the arithmetic below returns interned colors instead of new structures
     _fields_ = [('r', c_uint8),
                 ('g', c_uint8),
                 ('b', c_uint8),
                 ]
 
+    def __init__(self, r=0, g=0, b=0):
+        Structure.__setattr__(self, 'r', r)
+        Structure.__setattr__(self, 'g', g)
+        Structure.__setattr__(self, 'b', b)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Color is immutable, use color_get for another color")
+
     def __eq__(self, c):
-        return _lib.TCOD_color_equals(self, c)
+        return isinstance(c, Color) and self.r == c.r and self.g == c.g and self.b == c.b
+
+    def __hash__(self):
+        return self.r | self.g << 8 | self.b << 16
+
+    def __reduce__(self):
+        return (color_get, (self.r, self.g, self.b))
 
     def __mul__(self, c):
+        # same rounding and clamping as TCOD_color_multiply(_scalar)
         if isinstance(c,Color):
-            return _lib.TCOD_color_multiply(self, c)
+            return color_get(self.r * c.r // 255, self.g * c.g // 255, self.b * c.b // 255)
         else:
-            return _lib.TCOD_color_multiply_scalar(self, c_float(c))
+            return color_get(min(255, max(0, int(self.r * c))), min(255, max(0, int(self.g * c))),
+                             min(255, max(0, int(self.b * c))))
 
     def __add__(self, c):
-        return _lib.TCOD_color_add(self, c)
+        return color_get(min(255, self.r + c.r), min(255, self.g + c.g), min(255, self.b + c.b))
 
     def __sub__(self, c):
-        return _lib.TCOD_color_subtract(self, c)
+        return color_get(max(0, self.r - c.r), max(0, self.g - c.g), max(0, self.b - c.b))
 
     def __repr__(self):
         return "Color(%d,%d,%d)" % (self.r, self.g, self.b)
@@ -112,12 +132,6 @@ class Color(Structure):
         else:
             return getattr(self, "rgb"[i])
 
-    def __setitem__(self, i, c):
-        if type(i) == str:
-            setattr(self, i, c)
-        else:
-            setattr(self, "rgb"[i], c)
-
     def __iter__(self):
         yield self.r
         yield self.g
@@ -356,11 +370,37 @@ silver=Color(203,203,203)
 celadon=Color(172,255,175)
 peach=Color(255,159,127)
 
+# the intern table, seeded with the colors above
+_color_table = {}
+for _color in list(globals().values()):
+    if isinstance(_color, Color):
+        _color_table.setdefault((_color.r, _color.g, _color.b), _color)
+
+def color_get(r, g, b):
+    try:
+        return _color_table[(r, g, b)]
+    except KeyError:
+        color = _color_table[(r, g, b)] = Color(r, g, b)
+        return color
+
 # color functions
 _lib.TCOD_color_lerp.restype = Color
 def color_lerp(c1, c2, a):
     return _lib.TCOD_color_lerp(c1, c2, c_float(a))
 
+_lerp_tables = {}
+def color_lerp_table(c1, c2, steps):
+    # steps interned colors going from c1 to c2, both included, so shading or
+    # fading picks a color by index instead of lerping one for every cell
+    key = (c1, c2, steps)
+    if key not in _lerp_tables:
+        if steps == 1:
+            _lerp_tables[key] = (color_get(c1.r, c1.g, c1.b),)
+        else:
+            _lerp_tables[key] = tuple(color_get(c.r, c.g, c.b) for c in color_gen_map((c1, c2), (0, steps - 1)))
+    return _lerp_tables[key]
+
+# these two change c in place from C, so give them a Color of your own
 def color_set_hsv(c, h, s, v):
     _lib.TCOD_color_set_HSV(byref(c), c_float(h), c_float(s), c_float(v))
 
@@ -395,42 +435,85 @@ class Key(Structure):
               ('shift', c_bool),
               ]
 
+# background rendering modes
+BKGND_NONE = 0
+BKGND_SET = 1
+BKGND_MULTIPLY = 2
+BKGND_LIGHTEN = 3
+BKGND_DARKEN = 4
+BKGND_SCREEN = 5
+BKGND_COLOR_DODGE = 6
+BKGND_COLOR_BURN = 7
+BKGND_ADD = 8
+BKGND_ADDA = 9
+BKGND_BURN = 10
+BKGND_OVERLAY = 11
+BKGND_ALPH = 12
+BKGND_DEFAULT=13
+
+def BKGND_ALPHA(a):
+    return BKGND_ALPH | (int(a * 255) << 8)
+
+def BKGND_ADDALPHA(a):
+    return BKGND_ADDA | (int(a * 255) << 8)
+
+_BUFFER_PLANES = ('back_r', 'back_g', 'back_b', 'fore_r', 'fore_g', 'fore_b', 'char')
+
 class ConsoleBuffer:
     # simple console that allows direct (fast) access to cells. simplifies
-    # use of the "fill" functions.
+    # use of the "fill" functions. the cells are one block of C ints, holding
+    # the planes of _BUFFER_PLANES one after the other, and each plane is an
+    # attribute of the same name: a writable memoryview of its part, indexed
+    # like the lists it used to be. arrays() gives NumPy views of that memory
+    # for effects on the whole console, and blit hands it to libtcod as it is.
     def __init__(self, width, height, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
         # initialize with given width and height. values to fill the buffer
         # are optional, defaults to black with no characters.
         n = width * height
         self.width = width
         self.height = height
+        self.cells = array.array('i', [0]) * (len(_BUFFER_PLANES) * n)
+        self._split()
         self.clear(back_r, back_g, back_b, fore_r, fore_g, fore_b, char)
 
+    def _split(self):
+        # point the plane attributes at their part of the cells
+        n = self.width * self.height
+        cells = memoryview(self.cells)
+        for (i, name) in enumerate(_BUFFER_PLANES):
+            setattr(self, name, cells[i * n:(i + 1) * n])
+
     def clear(self, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
         # clears the console. values to fill it with are optional, defaults
-        # to black with no characters.
+        # to black with no characters. the cells are overwritten in place, so
+        # views already taken of them stay valid.
         n = self.width * self.height
-        self.back_r = [back_r] * n
-        self.back_g = [back_g] * n
-        self.back_b = [back_b] * n
-        self.fore_r = [fore_r] * n
-        self.fore_g = [fore_g] * n
-        self.fore_b = [fore_b] * n
-        self.char = [ord(char)] * n
-    
+        for (name, value) in zip(_BUFFER_PLANES, (back_r, back_g, back_b, fore_r, fore_g, fore_b, ord(char))):
+            getattr(self, name)[:] = array.array('i', [value]) * n
+
     def copy(self):
         # returns a copy of this ConsoleBuffer.
         other = ConsoleBuffer(0, 0)
         other.width = self.width
         other.height = self.height
-        other.back_r = list(self.back_r)  # make explicit copies of all lists
-        other.back_g = list(self.back_g)
-        other.back_b = list(self.back_b)
-        other.fore_r = list(self.fore_r)
-        other.fore_g = list(self.fore_g)
-        other.fore_b = list(self.fore_b)
-        other.char = list(self.char)
+        other.cells = array.array('i', self.cells)
+        other._split()
         return other
+
+    def arrays(self):
+        # NumPy views of the cells, sharing their memory: the background and
+        # foreground colors as (3, height, width) arrays of r, g and b planes,
+        # and the chars as a (height, width) array. writing to them writes the
+        # buffer, so fades and tints over the whole console copy nothing.
+        if not numpy_available:
+            raise ImportError('ConsoleBuffer.arrays needs NumPy, the plane memoryviews work without it')
+        planes = numpy.frombuffer(self.cells, dtype=numpy.intc).reshape(len(_BUFFER_PLANES), self.height, self.width)
+        return planes[0:3], planes[3:6], planes[6]
+
+    def _plane(self, name):
+        # a plane as a C int array over the cells, with no copy
+        n = self.width * self.height
+        return (c_int * n).from_buffer(self.cells, _BUFFER_PLANES.index(name) * n * sizeof(c_int))
     
     def set_fore(self, x, y, r, g, b, char):
         # set the character and foreground color of one cell.
@@ -457,21 +540,60 @@ class ConsoleBuffer:
         self.fore_g[i] = fore_g
         self.fore_b[i] = fore_b
         self.char[i] = ord(char)
-    
+
+    def put_chars(self, xs, ys, chars=None, fore=None, back=None, flag=BKGND_SET):
+        # write many cells at once, from parallel sequences: cell (xs[i], ys[i])
+        # gets chars[i] drawn in fore[i] on back[i]. a sequence left as None
+        # leaves that part of the cells alone. the backgrounds are blended in
+        # with flag, one of BKGND_NONE, SET, MULTIPLY, LIGHTEN, DARKEN, ADD
+        # or SCREEN. nothing reaches libtcod until the next blit.
+        width = self.width
+        cells = [width * y + x for (x, y) in zip(xs, ys)]
+        if chars is not None:
+            char = self.char
+            for (i, c) in zip(cells, chars):
+                char[i] = ord(c) if type(c) == str or type(c) == bytes else c
+        if fore is not None:
+            (r, g, b) = (self.fore_r, self.fore_g, self.fore_b)
+            for (i, color) in zip(cells, fore):
+                r[i] = color.r
+                g[i] = color.g
+                b[i] = color.b
+        if back is not None and flag != BKGND_NONE:
+            (r, g, b) = (self.back_r, self.back_g, self.back_b)
+            if flag == BKGND_SET:
+                for (i, color) in zip(cells, back):
+                    r[i] = color.r
+                    g[i] = color.g
+                    b[i] = color.b
+            else:
+                blend = _BUFFER_BLENDS[flag]
+                for (i, color) in zip(cells, back):
+                    r[i] = blend(r[i], color.r)
+                    g[i] = blend(g[i], color.g)
+                    b[i] = blend(b[i], color.b)
+
     def blit(self, dest, fill_fore=True, fill_back=True):
         # use libtcod's "fill" functions to write the buffer to a console.
         if (console_get_width(dest) != self.width or
             console_get_height(dest) != self.height):
             raise ValueError('ConsoleBuffer.blit: Destination console has an incorrect size.')
 
-        s = struct.Struct('%di' % len(self.back_r))
-
         if fill_back:
-            _lib.TCOD_console_fill_background(dest, (c_int * len(self.back_r))(*self.back_r), (c_int * len(self.back_g))(*self.back_g), (c_int * len(self.back_b))(*self.back_b))
+            _lib.TCOD_console_fill_background(dest, self._plane('back_r'), self._plane('back_g'), self._plane('back_b'))
 
         if fill_fore:
-            _lib.TCOD_console_fill_foreground(dest, (c_int * len(self.fore_r))(*self.fore_r), (c_int * len(self.fore_g))(*self.fore_g), (c_int * len(self.fore_b))(*self.fore_b))
-            _lib.TCOD_console_fill_char(dest, (c_int * len(self.char))(*self.char))
+            _lib.TCOD_console_fill_foreground(dest, self._plane('fore_r'), self._plane('fore_g'), self._plane('fore_b'))
+            _lib.TCOD_console_fill_char(dest, self._plane('char'))
+
+# the background blends ConsoleBuffer.put_chars does itself, as libtcod does them
+_BUFFER_BLENDS = {
+    BKGND_MULTIPLY: lambda old, new: old * new // 255,
+    BKGND_LIGHTEN: max,
+    BKGND_DARKEN: min,
+    BKGND_ADD: lambda old, new: min(255, old + new),
+    BKGND_SCREEN: lambda old, new: 255 - (255 - old) * (255 - new) // 255,
+    }
 
 _lib.TCOD_console_credits_render.restype = c_bool
 _lib.TCOD_console_is_fullscreen.restype = c_bool
@@ -483,27 +605,20 @@ _lib.TCOD_console_get_char_foreground.restype = Color
 _lib.TCOD_console_get_fading_color.restype = Color
 _lib.TCOD_console_is_key_pressed.restype = c_bool
 
-# background rendering modes
-BKGND_NONE = 0
-BKGND_SET = 1
-BKGND_MULTIPLY = 2
-BKGND_LIGHTEN = 3
-BKGND_DARKEN = 4
-BKGND_SCREEN = 5
-BKGND_COLOR_DODGE = 6
-BKGND_COLOR_BURN = 7
-BKGND_ADD = 8
-BKGND_ADDA = 9
-BKGND_BURN = 10
-BKGND_OVERLAY = 11
-BKGND_ALPH = 12
-BKGND_DEFAULT=13
-
-def BKGND_ALPHA(a):
-    return BKGND_ALPH | (int(a * 255) << 8)
-
-def BKGND_ADDALPHA(a):
-    return BKGND_ADDA | (int(a * 255) << 8)
+# full signatures for the calls made a few times a frame, for type safety:
+# ctypes checks and converts every argument, so a Python float reaches C as a
+# float rather than a double and a wrong type raises instead of passing
+# garbage. they are not there for speed, a typed call measures slower than an
+# untyped one, so the calls made for every cell (put_char, set_char*,
+# map_is_in_fov, map_set_properties, random_get_int...) stay undeclared: they
+# only take ints and colors, which ctypes passes correctly as they are
+_lib.TCOD_console_flush.argtypes = []
+_lib.TCOD_console_set_default_background.argtypes = [c_void_p, Color]
+_lib.TCOD_console_set_default_foreground.argtypes = [c_void_p, Color]
+_lib.TCOD_console_clear.argtypes = [c_void_p]
+_lib.TCOD_console_rect.argtypes = [c_void_p, c_int, c_int, c_int, c_int, c_bool, c_int]
+_lib.TCOD_console_blit.argtypes = [c_void_p, c_int, c_int, c_int, c_int, c_void_p, c_int, c_int, c_float, c_float]
+_lib.TCOD_console_is_key_pressed.argtypes = [c_int]
 
 # non blocking key events types
 KEY_PRESSED = 1
@@ -760,29 +875,49 @@ def console_set_default_foreground(con, col):
 def console_clear(con):
     return _lib.TCOD_console_clear(con)
 
+_console_put_char = _lib.TCOD_console_put_char
 def console_put_char(con, x, y, c, flag=BKGND_DEFAULT):
     if type(c) == str or type(c) == bytes:
-        _lib.TCOD_console_put_char(con, x, y, ord(c), flag)
-    else:
-        _lib.TCOD_console_put_char(con, x, y, c, flag)
+        c = ord(c)
+    _console_put_char(con, x, y, c, flag)
 
+_console_put_char_ex = _lib.TCOD_console_put_char_ex
 def console_put_char_ex(con, x, y, c, fore, back):
     if type(c) == str or type(c) == bytes:
-        _lib.TCOD_console_put_char_ex(con, x, y, ord(c), fore, back)
-    else:
-        _lib.TCOD_console_put_char_ex(con, x, y, c, fore, back)
+        c = ord(c)
+    _console_put_char_ex(con, x, y, c, fore, back)
 
+_console_set_char_background = _lib.TCOD_console_set_char_background
 def console_set_char_background(con, x, y, col, flag=BKGND_SET):
-    _lib.TCOD_console_set_char_background(con, x, y, col, flag)
+    _console_set_char_background(con, x, y, col, flag)
 
-def console_set_char_foreground(con, x, y, col):
-    _lib.TCOD_console_set_char_foreground(con, x, y, col)
+console_set_char_foreground = _lib.TCOD_console_set_char_foreground
 
+_console_set_char = _lib.TCOD_console_set_char
 def console_set_char(con, x, y, c):
     if type(c) == str or type(c) == bytes:
-        _lib.TCOD_console_set_char(con, x, y, ord(c))
-    else:
-        _lib.TCOD_console_set_char(con, x, y, c)
+        c = ord(c)
+    _console_set_char(con, x, y, c)
+
+def console_put_chars(con, xs, ys, chars=None, fore=None, back=None, flag=BKGND_SET):
+    # the batch write of ConsoleBuffer.put_chars, for a ConsoleBuffer or a
+    # console. libtcod has no call that writes scattered cells, so on a console
+    # this is still a call per cell and part; a ConsoleBuffer takes the batch
+    # with no calls at all and sends the whole console over in its blit
+    if isinstance(con, ConsoleBuffer):
+        con.put_chars(xs, ys, chars, fore, back, flag)
+        return
+    if chars is not None:
+        for (x, y, c) in zip(xs, ys, chars):
+            if type(c) == str or type(c) == bytes:
+                c = ord(c)
+            _console_set_char(con, x, y, c)
+    if fore is not None:
+        for (x, y, color) in zip(xs, ys, fore):
+            console_set_char_foreground(con, x, y, color)
+    if back is not None and flag != BKGND_NONE:
+        for (x, y, color) in zip(xs, ys, back):
+            _console_set_char_background(con, x, y, color, flag)
 
 def console_set_background_flag(con, flag):
     _lib.TCOD_console_set_background_flag(con, c_int(flag))
@@ -827,7 +962,7 @@ def console_get_height_rect(con, x, y, w, h, fmt):
         return _lib.TCOD_console_get_height_rect_utf(c_void_p(con), x, y, w, h, fmt)
 
 def console_rect(con, x, y, w, h, clr, flag=BKGND_DEFAULT):
-    _lib.TCOD_console_rect(con, x, y, w, h, c_int(clr), flag)
+    _lib.TCOD_console_rect(con, x, y, w, h, clr, flag)
 
 def console_hline(con, x, y, l, flag=BKGND_DEFAULT):
     _lib.TCOD_console_hline( con, x, y, l, flag)
@@ -877,8 +1012,7 @@ def console_check_for_keypress(flags=KEY_RELEASED):
     _lib.TCOD_console_check_for_keypress_wrapper(byref(k),c_int(flags))
     return k
 
-def console_is_key_pressed(key):
-    return _lib.TCOD_console_is_key_pressed(key)
+console_is_key_pressed = _lib.TCOD_console_is_key_pressed
 
 def console_set_keyboard_repeat(initial_delay, interval):
     _lib.TCOD_console_set_keyboard_repeat(initial_delay, interval)
@@ -898,7 +1032,7 @@ def console_get_height(con):
     return _lib.TCOD_console_get_height(con)
 
 def console_blit(src, x, y, w, h, dst, xdst, ydst, ffade=1.0,bfade=1.0):
-    _lib.TCOD_console_blit(src, x, y, w, h, dst, xdst, ydst, c_float(ffade), c_float(bfade))
+    _lib.TCOD_console_blit(src, x, y, w, h, dst, xdst, ydst, ffade, bfade)
 
 def console_set_key_color(con, col):
     _lib.TCOD_console_set_key_color(con, col)
@@ -907,59 +1041,55 @@ def console_delete(con):
     _lib.TCOD_console_delete(con)
 
 # fast color filling
+def _fill_ints(arr, cells):
+    # arr as an int array for the fill calls, which read one int per cell.
+    # NumPy arrays and contiguous buffers of C ints (array('i'), memoryviews,
+    # ctypes arrays...) are passed by address with no per-element work. other
+    # buffers, like a bytearray of chars, are widened to C ints in one C level
+    # copy, and anything else, like a list, is copied item by item
+    if numpy_available and isinstance(arr, numpy.ndarray):
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
+        carr = arr.ctypes.data_as(POINTER(c_int))
+        n = arr.size
+    else:
+        try:
+            view = memoryview(arr)
+        except TypeError:
+            view = None
+        if view is None:
+            carr = (c_int * len(arr))(*arr)
+        elif view.itemsize == sizeof(c_int) and view.format[-1:] in ('i', 'l') and view.c_contiguous:
+            view = view.cast('B').cast('i')
+            if view.readonly:
+                carr = (c_int * len(view)).from_buffer_copy(view)
+            else:
+                carr = (c_int * len(view)).from_buffer(view)
+        else:
+            ints = array.array('i', view)
+            carr = (c_int * len(ints)).from_buffer(ints)
+        n = len(carr)
+    if n < cells:
+        raise ValueError('%d values to fill a console of %d cells.' % (n, cells))
+    return carr
+
 def console_fill_foreground(con,r,g,b) :
     if len(r) != len(g) or len(r) != len(b):
         raise TypeError('R, G and B must all have the same size.')
 
-    if (numpy_available and isinstance(r, numpy.ndarray) and
-        isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
-        #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
-        cr = r.ctypes.data_as(POINTER(c_int))
-        cg = g.ctypes.data_as(POINTER(c_int))
-        cb = b.ctypes.data_as(POINTER(c_int))
-    else:
-        # otherwise convert using ctypes arrays
-        cr = (c_int * len(r))(*r)
-        cg = (c_int * len(g))(*g)
-        cb = (c_int * len(b))(*b)
-
-    _lib.TCOD_console_fill_foreground(con, cr, cg, cb)
+    cells = console_get_width(con) * console_get_height(con)
+    _lib.TCOD_console_fill_foreground(con, _fill_ints(r, cells), _fill_ints(g, cells), _fill_ints(b, cells))
 
 def console_fill_background(con,r,g,b) :
     if len(r) != len(g) or len(r) != len(b):
         raise TypeError('R, G and B must all have the same size.')
 
-    if (numpy_available and isinstance(r, numpy.ndarray) and
-        isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
-        #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
-        cr = r.ctypes.data_as(POINTER(c_int))
-        cg = g.ctypes.data_as(POINTER(c_int))
-        cb = b.ctypes.data_as(POINTER(c_int))
-    else:
-        # otherwise convert using ctypes arrays
-        cr = (c_int * len(r))(*r)
-        cg = (c_int * len(g))(*g)
-        cb = (c_int * len(b))(*b)
-
-    _lib.TCOD_console_fill_background(con, cr, cg, cb)
+    cells = console_get_width(con) * console_get_height(con)
+    _lib.TCOD_console_fill_background(con, _fill_ints(r, cells), _fill_ints(g, cells), _fill_ints(b, cells))
 
 def console_fill_char(con,arr) :
-    if (numpy_available and isinstance(arr, numpy.ndarray) ):
-        #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
-        carr = arr.ctypes.data_as(POINTER(c_int))
-    else:
-        #otherwise convert using the struct module
-        carr = struct.pack('%di' % len(arr), *arr)
+    cells = console_get_width(con) * console_get_height(con)
+    _lib.TCOD_console_fill_char(con, _fill_ints(arr, cells))
 
-    _lib.TCOD_console_fill_char(con, carr)
-        
 def console_load_asc(con, filename) :
     _lib.TCOD_console_load_asc(con,filename)
 def console_save_asc(con, filename) :
@@ -1052,6 +1182,10 @@ def sys_wait_for_event(mask,k,m,flush) :
 _lib.TCOD_line_step.restype = c_bool
 _lib.TCOD_line.restype=c_bool
 _lib.TCOD_line_step_mt.restype = c_bool
+_lib.TCOD_line_init.argtypes = [c_int, c_int, c_int, c_int]
+_lib.TCOD_line_step.argtypes = [POINTER(c_int), POINTER(c_int)]
+_lib.TCOD_line_init_mt.argtypes = [c_int, c_int, c_int, c_int, POINTER(c_int)]
+_lib.TCOD_line_step_mt.argtypes = [POINTER(c_int), POINTER(c_int), POINTER(c_int)]
 
 def line_init(xo, yo, xd, yd):
     _lib.TCOD_line_init(xo, yo, xd, yd)
@@ -1064,6 +1198,65 @@ def line_step():
         return x.value, y.value
     return None,None
 
+def line_points(xo, yo, xd, yd):
+    # the points of many lines at once, the same ones line_iter steps through:
+    # line i goes from (xo[i], yo[i]) to (xd[i], yd[i]), both included. returns
+    # (xs, ys, starts), the points of every line one after the other, with line
+    # i's at [starts[i]:starts[i + 1]]. the minor axis coordinate of the k-th
+    # point has a closed form, so with NumPy there is no loop over the points
+    # and the results are arrays; without it they are lists.
+    if numpy_available:
+        xo = numpy.asarray(xo, dtype=int)
+        yo = numpy.asarray(yo, dtype=int)
+        dx = numpy.asarray(xd, dtype=int) - xo
+        dy = numpy.asarray(yd, dtype=int) - yo
+        xmajor = abs(dx) > abs(dy)
+        major = numpy.where(xmajor, abs(dx), abs(dy))
+        minor = numpy.where(xmajor, abs(dy), abs(dx))
+        starts = numpy.zeros(len(major) + 1, dtype=int)
+        numpy.cumsum(major + 1, out=starts[1:])
+        line = numpy.repeat(numpy.arange(len(major)), major + 1)
+        k = numpy.arange(starts[-1]) - starts[line]
+        (xmajor, major, minor) = (xmajor[line], major[line], minor[line])
+        # minor steps taken after k major ones, as TCOD_line_step_mt counts them
+        m = numpy.maximum(0, -((major - 2 * k * minor) // numpy.maximum(2 * major, 1)))
+        xs = xo[line] + numpy.where(xmajor, k, m) * numpy.sign(dx)[line]
+        ys = yo[line] + numpy.where(xmajor, m, k) * numpy.sign(dy)[line]
+        return xs, ys, starts
+
+    (xs, ys, starts) = ([], [], [0])
+    for (x0, y0, x1, y1) in zip(xo, yo, xd, yd):
+        (dx, dy) = (x1 - x0, y1 - y0)
+        (sx, sy) = ((dx > 0) - (dx < 0), (dy > 0) - (dy < 0))
+        (major, minor) = (abs(dx), abs(dy)) if abs(dx) > abs(dy) else (abs(dy), abs(dx))
+        for k in range(major + 1):
+            m = max(0, -((major - 2 * k * minor) // max(2 * major, 1)))
+            if abs(dx) > abs(dy):
+                xs.append(x0 + k * sx)
+                ys.append(y0 + m * sy)
+            else:
+                xs.append(x0 + m * sx)
+                ys.append(y0 + k * sy)
+        starts.append(len(xs))
+    return xs, ys, starts
+
+def line_of_sight(xo, yo, xd, yd, transparent):
+    # for each of many lines, laid out as for line_points, whether every point
+    # strictly between its two ends is transparent. transparent is indexed
+    # [y][x], a (height, width) bool array with NumPy or a list of rows. all
+    # the lines are traced in one batch, so checking hundreds of them stays
+    # cheap. returns a bool array with NumPy, a list otherwise
+    (xs, ys, starts) = line_points(xo, yo, xd, yd)
+    if numpy_available:
+        opaque = ~numpy.asarray(transparent, dtype=bool)[ys, xs]
+        opaque[starts[:-1]] = False # the ends of a line don't hide anything
+        opaque[starts[1:] - 1] = False
+        if len(opaque) == 0:
+            return numpy.ones(0, dtype=bool)
+        return ~numpy.logical_or.reduceat(opaque, starts[:-1])
+    return [all(transparent[ys[i]][xs[i]] for i in range(start + 1, end - 1))
+            for (start, end) in zip(starts, starts[1:])]
+
 def line(xo,yo,xd,yd,py_callback) :
     LINE_CBK_FUNC=CFUNCTYPE(c_bool,c_int,c_int)
     c_callback=LINE_CBK_FUNC(py_callback)
@@ -1415,8 +1608,7 @@ def random_new_from_seed(seed, algo=RNG_CMWC):
 def random_set_distribution(rnd, dist) :
 	_lib.TCOD_random_set_distribution(rnd, dist)
 
-def random_get_int(rnd, mi, ma):
-    return _lib.TCOD_random_get_int(rnd, mi, ma)
+random_get_int = _lib.TCOD_random_get_int
 
 def random_get_float(rnd, mi, ma):
     return _lib.TCOD_random_get_float(rnd, c_float(mi), c_float(ma))
@@ -1482,6 +1674,46 @@ def noise_get_fbm(n, f, oc, typ=NOISE_DEFAULT):
 def noise_get_turbulence(n, f, oc, typ=NOISE_DEFAULT):
     return _lib.TCOD_noise_get_turbulence_ex(n, _NOISE_PACKER_FUNC[len(f)](*f), c_float(oc), typ)
 
+def noise_get_fbm_grid(n, width, height, offset=(0.0, 0.0), scale=(1.0, 1.0), octaves=4.0):
+    # noise_get_fbm at every cell of a width x height grid, in one call: cell
+    # (x, y) is sampled at ((x + offset[0]) * scale[0], (y + offset[1]) * scale[1]).
+    # libtcod evaluates it all into a heightmap, with the type set by
+    # noise_set_type. returns a (height, width) float array with NumPy, a list
+    # of rows otherwise
+    hm = heightmap_new(width, height)
+    heightmap_add_fbm(hm, n, scale[0] * width, scale[1] * height, offset[0], offset[1], octaves, 0.0, 1.0)
+    values = hm.p.contents.values
+    if numpy_available:
+        grid = numpy.ctypeslib.as_array(values, shape=(height, width)).copy()
+    else:
+        grid = [values[y * width:(y + 1) * width] for y in range(height)]
+    heightmap_delete(hm)
+    return grid
+
+def noise_get_grid(n, width, height, offset=(0.0, 0.0), scale=(1.0, 1.0)):
+    # noise_get at every cell of the grid, in one call: a single octave of fBm
+    # is the base noise itself
+    return noise_get_fbm_grid(n, width, height, offset, scale, 1.0)
+
+def noise_get_turbulence_grid(n, width, height, offset=(0.0, 0.0), scale=(1.0, 1.0), octaves=4.0, typ=NOISE_DEFAULT):
+    # the same grid for turbulence. this one is NOT batched: libtcod has no
+    # grid call for turbulence, so it is still a call per cell, only reusing
+    # one point buffer instead of packing a new one each time
+    f = (c_float * 2)()
+    get = _lib.TCOD_noise_get_turbulence_ex
+    octaves = c_float(octaves)
+    grid = []
+    for y in range(height):
+        f[1] = (y + offset[1]) * scale[1]
+        row = []
+        for x in range(width):
+            f[0] = (x + offset[0]) * scale[0]
+            row.append(get(n, f, octaves, typ))
+        grid.append(row)
+    if numpy_available:
+        return numpy.array(grid, dtype=numpy.float32)
+    return grid
+
 def noise_delete(n):
     _lib.TCOD_noise_delete(n)
 
@@ -1491,6 +1723,7 @@ def noise_delete(n):
 _lib.TCOD_map_is_in_fov.restype = c_bool
 _lib.TCOD_map_is_transparent.restype = c_bool
 _lib.TCOD_map_is_walkable.restype = c_bool
+_lib.TCOD_map_compute_fov.argtypes = [c_void_p, c_int, c_int, c_int, c_bool, c_int]
 
 FOV_BASIC = 0
 FOV_DIAMOND = 1
@@ -1516,23 +1749,17 @@ def map_new(w, h):
 def map_copy(source, dest):
     return _lib.TCOD_map_copy(source, dest)
 
-def map_set_properties(m, x, y, isTrans, isWalk):
-    _lib.TCOD_map_set_properties(m, x, y, c_int(isTrans), c_int(isWalk))
+map_set_properties = _lib.TCOD_map_set_properties
 
 def map_clear(m,walkable=False,transparent=False):
     _lib.TCOD_map_clear(m,c_int(walkable),c_int(transparent))
 
 def map_compute_fov(m, x, y, radius=0, light_walls=True, algo=FOV_RESTRICTIVE ):
-    _lib.TCOD_map_compute_fov(m, x, y, c_int(radius), c_bool(light_walls), c_int(algo))
-
-def map_is_in_fov(m, x, y):
-    return _lib.TCOD_map_is_in_fov(m, x, y)
-
-def map_is_transparent(m, x, y):
-    return _lib.TCOD_map_is_transparent(m, x, y)
+    _lib.TCOD_map_compute_fov(m, x, y, radius, light_walls, algo)
 
-def map_is_walkable(m, x, y):
-    return _lib.TCOD_map_is_walkable(m, x, y)
+map_is_in_fov = _lib.TCOD_map_is_in_fov
+map_is_transparent = _lib.TCOD_map_is_transparent
+map_is_walkable = _lib.TCOD_map_is_walkable
 
 def map_delete(m):
     return _lib.TCOD_map_delete(m)
@@ -1549,6 +1776,9 @@ def map_get_height(map):
 _lib.TCOD_path_compute.restype = c_bool
 _lib.TCOD_path_is_empty.restype = c_bool
 _lib.TCOD_path_walk.restype = c_bool
+_lib.TCOD_path_compute.argtypes = [c_void_p, c_int, c_int, c_int, c_int]
+_lib.TCOD_path_size.argtypes = [c_void_p]
+_lib.TCOD_path_get.argtypes = [c_void_p, c_int, POINTER(c_int), POINTER(c_int)]
 
 PATH_CBK_FUNC = CFUNCTYPE(c_float, c_int, c_int, c_int, c_int, py_object)
 